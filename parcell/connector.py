@@ -4,15 +4,28 @@ from __future__ import print_function
 from __future__ import division
 
 import os
+import re
 import sys
+import json
 import math
+import stat
+import itertools
+import time
+import uuid
 import logging
+import posixpath
+import collections
 import argparse
 import threading
+import traceback
 from rpaths import PosixPath
 from tej import RemoteQueue, JobNotFound, RemoteCommandFailure, JobAlreadyExists
+from tej.utils import shell_escape
 
+import index
 import loading
+import transfer
+import scheduler
 
 def msg(message, *args, **kwargs):
     print(message.format(*args, **kwargs), file=sys.stdout)
@@ -21,6 +34,8 @@ def set_msg(m):
     global msg
     msg = m
     loading.set_msg(m)
+    scheduler.set_msg(m)
+    index.set_msg(m)
 
 def get_envs():
     return loading.get_envs()
@@ -34,14 +49,256 @@ def get_projects():
 def set_password_reuse(reuse_pw):
     loading.set_password_reuse(reuse_pw)
 
-def init_passwords():
-    loading.init_passwords()
+def init_passwords(wait=True):
+    loading.init_passwords(wait)
 
 def get_connector(project):
-    with loading.MAIN_LOCK:
-        if project not in Connector._ALL_CONNECTORS:
-            Connector(project) # adds itself to the list
-        return Connector._ALL_CONNECTORS[project]
+    return loading.get_cached(Connector._ALL_CONNECTORS, "connector", project, Connector)
+
+def resume_schedulers():
+    """Starts the connectors of all projects with queued jobs so that their
+       schedulers continue dispatching after a restart.
+    """
+    for p in loading.get_queued_projects():
+        get_connector(p)
+
+VITALS_TIMEOUT = 10
+
+DISPATCH_WINDOW = 60
+DISPATCH_PENALTY = 0.5
+
+LISTINGS_CACHE = 256
+LISTING_SORTS = [ "mtime", "name", "size" ]
+
+JOBS_POLL_INTERVAL = 2
+JOBS_HISTORY = 100
+
+STATS_VITALS_TTL = 5
+STATS_VERSIONS_TTL = 60 * 60
+STATS_IDLE = 60
+def set_stats_ttl(vitals_ttl, versions_ttl):
+    global STATS_VITALS_TTL
+    global STATS_VERSIONS_TTL
+    STATS_VITALS_TTL = vitals_ttl
+    STATS_VERSIONS_TTL = versions_ttl
+
+FILE_CHUNK = 1 << 20
+LOCAL_COPIES = False
+def set_local_copies(local_copies):
+    """Whether job files are downloaded to DIR_TEMP before they are served.
+       Otherwise they are streamed directly from the server.
+    """
+    global LOCAL_COPIES
+    LOCAL_COPIES = local_copies
+
+FILE_QUOTA = None
+FILE_TAIL_CHECK = 4096
+def set_file_quota(quota):
+    """Sets the budget for local copies of job files in MB (like the quota
+       of the cache) or None for no limit.
+    """
+    global FILE_QUOTA
+    FILE_QUOTA = None if quota is None else float(quota) * 1024 * 1024
+
+_TEMP_LOCK = threading.RLock()
+# local copies in least recently used order with their sizes
+_TEMP_FILES = None
+_TEMP_SIZE = [ 0 ]
+_TEMP_IN_USE = collections.Counter()
+def _get_temp_files():
+    """Returns the local copies of job files. DIR_TEMP is only read the
+       first time. Afterwards the copies are tracked as they are synced.
+    """
+    global _TEMP_FILES
+    with _TEMP_LOCK:
+        if _TEMP_FILES is None:
+            files = []
+            for (root, _, fnames) in os.walk(loading.DIR_TEMP):
+                for fname in fnames:
+                    full = os.path.join(root, fname)
+                    try:
+                        st = os.stat(full)
+                    except OSError:
+                        continue
+                    files.append((st.st_atime, full, st.st_size))
+            files.sort()
+            _TEMP_FILES = collections.OrderedDict((full, size) for (_, full, size) in files)
+            _TEMP_SIZE[0] = sum(_TEMP_FILES.values())
+        return _TEMP_FILES
+
+def _temp_path(s, j, req_file):
+    return str(PosixPath(loading.DIR_TEMP) / s / j / req_file)
+
+def _note_temp_file(full):
+    """Marks a local copy as most recently used and updates its size."""
+    try:
+        size = os.path.getsize(full)
+    except OSError:
+        size = None
+    with _TEMP_LOCK:
+        files = _get_temp_files()
+        _TEMP_SIZE[0] -= files.pop(full, 0)
+        if size is not None:
+            files[full] = size
+            _TEMP_SIZE[0] += size
+
+def _use_temp_file(full):
+    with _TEMP_LOCK:
+        _TEMP_IN_USE[full] += 1
+
+def _release_temp_file(full):
+    with _TEMP_LOCK:
+        _TEMP_IN_USE[full] -= 1
+        if _TEMP_IN_USE[full] <= 0:
+            del _TEMP_IN_USE[full]
+
+def _evict_temp_files(keep):
+    """Removes the least recently used local copies of job files until all
+       of them fit into FILE_QUOTA. Copies that are open or being synced are
+       skipped.
+    """
+    if FILE_QUOTA is None:
+        return
+    with _TEMP_LOCK:
+        files = _get_temp_files()
+        if _TEMP_SIZE[0] <= FILE_QUOTA:
+            return
+        # copies of deleted jobs are removed without being tracked
+        for full in [ full for full in files if not os.path.exists(full) ]:
+            _TEMP_SIZE[0] -= files.pop(full)
+        for full in list(files.keys()):
+            if _TEMP_SIZE[0] <= FILE_QUOTA:
+                break
+            if full == keep or full in _TEMP_IN_USE:
+                continue
+            lock = loading.key_lock("temp_file", full)
+            if not lock.acquire(False):
+                continue
+            try:
+                os.remove(full)
+            except OSError:
+                if os.path.exists(full):
+                    continue
+            finally:
+                lock.release()
+            _TEMP_SIZE[0] -= files.pop(full)
+
+def _is_prefix(sftp_file, local, size):
+    """Checks whether the last bytes of the local copy are still the same on
+       the server, i.e., whether the remote file only got appended to.
+    """
+    check = min(size, FILE_TAIL_CHECK)
+    with open(local, 'rb') as f:
+        f.seek(size - check)
+        expect = f.read(check)
+    sftp_file.seek(size - check)
+    return sftp_file.read(check) == expect
+
+def _sync_file(sftp, remote, local, rst):
+    """Updates the local copy of a remote file. Copies whose size and mtime
+       match the server are used as is and growing files only fetch the
+       missing tail. The mtime of the copy mirrors the server.
+    """
+    try:
+        lst = os.stat(local)
+    except OSError:
+        lst = None
+    if lst is not None and lst.st_size == rst.st_size and int(lst.st_mtime) == int(rst.st_mtime):
+        os.utime(local, (time.time(), rst.st_mtime))
+        return
+    with sftp.open(remote, 'rb') as f:
+        if lst is not None and 0 < lst.st_size < rst.st_size and _is_prefix(f, local, lst.st_size):
+            start, mode = lst.st_size, 'ab'
+        else:
+            start, mode = 0, 'wb'
+        f.seek(start)
+        left = rst.st_size - start
+        with open(local, mode) as out:
+            while left > 0:
+                buff = f.read(min(FILE_CHUNK, left))
+                if not buff:
+                    break
+                out.write(buff)
+                left -= len(buff)
+    os.utime(local, (time.time(), rst.st_mtime))
+
+_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+def expand_sweep(template, grid=None, points=None):
+    """Creates the commands of a parameter sweep. Placeholders like {lr} in
+       the template are replaced by the shell escaped values of each point.
+       Points are either given as list of dicts or as grid, i.e., a dict
+       mapping parameter names to lists of values whose cartesian product
+       is used. Unknown placeholders are kept as is.
+    """
+    if points is None:
+        points = []
+    if grid:
+        names = sorted(grid.keys())
+        points = list(points) + [ dict(zip(names, vals)) for vals in itertools.product(*[ grid[n] for n in names ]) ]
+
+    def fill(point):
+        return _PLACEHOLDER.sub(lambda m: shell_escape("{0}".format(point[m.group(1)])) if m.group(1) in point else m.group(0), template)
+
+    return [ fill(point) for point in points ]
+
+class RangeReader(object):
+    """A file like object reading length bytes of an open file. Reads are
+       passed to the file directly and return at most FILE_CHUNK bytes if
+       no size is given. The memory needed is independent of the file size.
+    """
+    def __init__(self, f, length, on_close=None):
+        self._f = f
+        self._left = length
+        self._pos = 0
+        self._on_close = on_close
+
+    def read(self, size=-1):
+        if size < 0:
+            size = FILE_CHUNK
+        size = min(size, self._left)
+        if size <= 0:
+            return ""
+        res = self._f.read(size)
+        if not res: # the file got truncated
+            self._left = 0
+        self._left -= len(res)
+        self._pos += len(res)
+        return res
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._f is None:
+            return
+        try:
+            self._f.close()
+        finally:
+            self._f = None
+            if self._on_close is not None:
+                self._on_close()
+
+def _get_range(size, offset, length, tail):
+    if tail is not None:
+        start = max(0, size - tail)
+    else:
+        start = min(size, offset or 0)
+    end = size if length is None else min(size, start + length)
+    return start, max(0, end - start)
+
+_ID_LOCK = threading.Lock()
+_ID_LAST = [ 0 ]
+def new_job_ids(project, num):
+    """Creates num unique job ids for the project. The ids are ordered by
+       their creation time (in ms, strictly increasing within the process)
+       and carry a random suffix to not collide with ids created by other
+       processes.
+    """
+    with _ID_LOCK:
+        stamp = max(int(time.time() * 1000), _ID_LAST[0] + 1)
+        _ID_LAST[0] = stamp + num - 1
+    rnd = uuid.uuid4().hex[:4]
+    return [ "{0}_{1:011x}{2}".format(project, stamp + ix, rnd) for ix in range(num) ]
 
 class Connector(object):
     SCRIPT_FILE = "_start"
@@ -50,9 +307,30 @@ class Connector(object):
 
     def __init__(self, p):
         self._lock = threading.RLock()
-        self._job_number = 0
+        self._finished = {}
+        self._listings = collections.OrderedDict()
+        self._dispatched = collections.deque()
         self._project = loading.get_project(p)
-        self._rqs = dict([ (s.name, loading.get_remote(s)) for s in self._project["servers"] ])
+        self._journal_path = loading.get_journal_path(p)
+        self._journal = self._load_journal()
+        self._index = index.ProjectIndex(p, self._project.path_local, skip=[ Connector.SCRIPT_FILE ])
+        self._stats = {}
+        self._stats_pending = {}
+        self._stats_cond = threading.Condition()
+        self._stats_wake = threading.Event()
+        self._stats_access = time.time()
+        t = threading.Thread(target=self._stats_loop, name="Stats-{0}".format(p))
+        t.daemon = True
+        t.start()
+        self._jobs = {}
+        self._jobs_order = []
+        self._jobs_version = 0
+        self._jobs_history = []
+        self._jobs_listeners = 0
+        self._jobs_thread = None
+        self._jobs_cond = threading.Condition()
+        self._jobs_wake = threading.Event()
+        self._scheduler = scheduler.Scheduler(self, p)
         Connector._ALL_CONNECTORS[p] = self
 
     def get_path(self):
@@ -64,12 +342,46 @@ class Connector(object):
     def get_env(self):
         return self._project["env"].name
 
-    def _get_env(self, rq, chk):
+    def _start_probe(self, rq, chks):
+        """Starts the commands of all checks in a single remote call. The
+           output of each command is delimited by a unique marker line. The
+           result of the call is a list of (exit code, output) tuples in the
+           order of chks.
+        """
+        if not chks:
+            return loading.RemoteCall.completed([])
+        marker = "@@PARCELL_{0}@@".format(uuid.uuid4().hex)
+        script = "\n".join(
+            "echo {0}\n( {1}\n)\nret=$?\necho\necho {0} $ret".format(marker, chk[1]) for chk in chks
+        )
+
+        def parse(ret, output):
+            if ret != 0:
+                raise RemoteCommandFailure(command="probe", ret=ret)
+            res = []
+            cur = None
+            for l in output.split("\n"):
+                if l == marker:
+                    cur = []
+                elif l.startswith(marker + " "):
+                    out = "\n".join(cur[:-1] if cur and not cur[-1] else cur)
+                    res.append((int(l[len(marker) + 1:]), out.rstrip("\r\n")))
+                    cur = None
+                elif cur is not None:
+                    cur.append(l)
+            if len(res) != len(chks):
+                raise ValueError("expected {0} sections got {1}".format(len(chks), len(res)))
+            return res
+
+        return rq.start_call(script, parse=parse)
+
+    def _match_env(self, chk, ret, output):
         if len(chk) == 4:
             name, cmd, regex, line = chk
         else:
             name, cmd, regex, line, _ = chk
-        output = rq.check_output(cmd)
+        if ret != 0:
+            raise RemoteCommandFailure(command=cmd, ret=ret)
         oarr = output.split("\n")
         if line >= len(oarr):
             raise ValueError("line {0} not in:\n{1}".format(line, oarr))
@@ -78,8 +390,8 @@ class Connector(object):
             raise ValueError("unexpected mismatch {0} not in:\n{1}".format(regex.pattern, oarr[line]))
         return name, m.group(1)
 
-    def get_vital_value(self, rq, chk):
-        name, c = self._get_env(rq, chk)
+    def _match_vital(self, chk, ret, output):
+        name, c = self._match_env(chk, ret, output)
         asc = chk[4]
         if c:
             try:
@@ -88,57 +400,248 @@ class Connector(object):
                 pass
         return name, float('nan'), asc
 
-    def get_vitals(self, rq):
-        return [ self.get_vital_value(rq, b) for b in self._project["env"]["vital"] ]
-
     def get_servers(self):
         return [ s.name for s in self._project["servers"] ]
 
+    def _rq(self, s):
+        # connecting lazily keeps slow servers from blocking the others
+        return loading.get_remote(self._project.servers[s])
+
     def get_servers_info(self):
+        stats = self._get_stats()
         return [ {
             "server": s,
-            "vital": self.get_vital_value(self._rqs[s], self._project["env"]["vital"][0])[1],
+            "vital": stats[s]["vitals"][0][1] if s in stats and stats[s]["vitals"] else float('nan'),
+            "ready": loading.get_readiness(s),
         } for s in self.get_servers() ]
 
     def get_server_stats(self, s):
         server = self._project.servers[s]
-        rq = self._rqs[s]
+        st = self._get_stats(s).get(s, {})
         return {
             "name": server["hostname"],
-            "versions": [ self._get_env(rq, chk) for chk in self._project["env"]["versions"] ],
-            "vitals": self.get_vitals(self._rqs[s]),
+            "versions": st.get("versions", []),
+            "vitals": st.get("vitals", []),
+            "changes": self._index.get_changes(s),
         }
 
     def get_all_vitals(self):
-        return [ (s, self.get_vitals(self._rqs[s])) for s in self.get_servers() ]
+        """Returns the cached vitals of all servers. Servers that failed or
+           did not answer during the last refresh are left out.
+        """
+        stats = self._get_stats()
+        return [ (s, stats[s]["vitals"]) for s in self.get_servers() if s in stats and stats[s]["available"] ]
+
+    def _get_stats(self, s=None):
+        """Returns a copy of the cached stats. Only the very first access of
+           a server waits for the background refresher (at most
+           VITALS_TIMEOUT seconds). All later accesses return immediately.
+        """
+        self._stats_access = time.time()
+        self._stats_wake.set()
+        servers = self.get_servers() if s is None else [ s ]
+        end = time.time() + VITALS_TIMEOUT
+        with self._stats_cond:
+            while not all(cs in self._stats for cs in servers):
+                left = end - time.time()
+                if left <= 0:
+                    break
+                self._stats_cond.wait(left)
+            return dict((cs, dict(st)) for (cs, st) in self._stats.items())
+
+    def _match_stats(self, s, versions, outputs):
+        vital = self._project["env"]["vital"]
+
+        def match(method, chk, ret, output):
+            try:
+                return method(chk, ret, output)
+            except (ValueError, RemoteCommandFailure) as e:
+                msg("check {0} failed on {1}: {2}", chk[0], s, e)
+                return (chk[0], float('nan'), chk[4]) if len(chk) > 4 else (chk[0], "?")
+
+        return (
+            [ match(self._match_env, chk, ret, output) for (chk, (ret, output)) in zip(versions, outputs) ],
+            [ match(self._match_vital, chk, ret, output) for (chk, (ret, output)) in zip(vital, outputs[len(versions):]) ],
+        )
+
+    def _refresh_stats(self):
+        """Probes all servers concurrently. The probes are started by a few
+           worker threads and their outputs are collected by the reactor
+           while this thread waits for them.
+        """
+        now = time.time()
+        vital = self._project["env"]["vital"]
+
+        def store(s, available, versions, vitals):
+            with self._stats_cond:
+                st = self._stats.setdefault(s, {
+                    "versions": [],
+                })
+                st["time"] = now
+                st["available"] = available
+                st["vitals"] = vitals
+                if versions is not None:
+                    st["versions"] = versions
+                    st["versions_time"] = now
+                self._stats_cond.notify_all()
+
+        def start(s):
+            with self._stats_cond:
+                # a hanging host keeps its previous probe -- don't pile up more
+                if s in self._stats_pending and not self._stats_pending[s].done():
+                    return None
+                versions_time = self._stats.get(s, {}).get("versions_time", float('-inf'))
+            versions = self._project["env"]["versions"] if now - versions_time >= STATS_VERSIONS_TTL else []
+            call = self._start_probe(self._rq(s), versions + vital)
+            with self._stats_cond:
+                self._stats_pending[s] = call
+            return versions, call
+
+        def unavailable(s, err):
+            msg("server {0} is unavailable: {1}", s, err)
+            store(s, False, None, [ (name, float('nan'), asc) for (name, _, _, _, asc) in vital ])
+
+        end = now + VITALS_TIMEOUT
+        for (s, res, err) in loading.run_parallel(start, self.get_servers(), timeout=VITALS_TIMEOUT):
+            if err is not None:
+                unavailable(s, err)
+                continue
+            if res is None:
+                continue
+            versions, call = res
+            try:
+                outputs = call.wait(max(0, end - time.time()))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                unavailable(s, e)
+                continue
+            with self._stats_cond:
+                self._stats_pending.pop(s, None)
+            versions, vitals = self._match_stats(s, versions, outputs)
+            store(s, True, versions if versions else None, vitals)
+
+    def _stats_loop(self):
+        while True:
+            if time.time() - self._stats_access > STATS_IDLE:
+                self._stats_wake.clear()
+                if time.time() - self._stats_access > STATS_IDLE:
+                    self._stats_wake.wait()
+            try:
+                self._refresh_stats()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                msg("Error refreshing server stats:\n{0}", traceback.format_exc())
+            try:
+                # the stats report the changes of the last refresh
+                self._index.refresh(index.INDEX_TTL)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                msg("Error indexing project:\n{0}", traceback.format_exc())
+            time.sleep(STATS_VITALS_TTL)
+
+    def _note_dispatch(self, s, num=1):
+        now = time.time()
+        with self._lock:
+            self._dispatched.extend([ (now, s) ] * num)
+
+    def _recent_dispatches(self):
+        """Counts the jobs per server that were started within the last
+           DISPATCH_WINDOW seconds and might not show in the vitals yet.
+        """
+        limit = time.time() - DISPATCH_WINDOW
+        res = {}
+        with self._lock:
+            while self._dispatched and self._dispatched[0][0] < limit:
+                self._dispatched.popleft()
+            for (_, s) in self._dispatched:
+                res[s] = res.get(s, 0) + 1
+        return res
+
+    def score_servers(self, all_vitals=None):
+        """Scores all servers with vitals that are within the thresholds of
+           the environment. The score is the weighted sum of the normalized
+           vitals, where 0 is best for every vital, plus DISPATCH_PENALTY
+           for every recently started job. all_vitals can be a result of
+           get_all_vitals to score an earlier snapshot of the vitals.
+           Returns (server, score) tuples with the best server first.
+        """
+        if all_vitals is None:
+            all_vitals = self.get_all_vitals()
+        scoring = self._project["env"]["scoring"]
+        cands = []
+        for (s, vitals) in all_vitals:
+            ok = True
+            for (name, num, asc) in vitals:
+                threshold = scoring[name]["threshold"] if name in scoring else None
+                if threshold is not None and (math.isnan(num) or (num > threshold if asc else num < threshold)):
+                    ok = False
+            if ok:
+                cands.append((s, vitals))
+        ranges = {}
+        for (s, vitals) in cands:
+            for (name, num, asc) in vitals:
+                if not math.isnan(num):
+                    lo, hi = ranges.get(name, (num, num))
+                    ranges[name] = (min(lo, num), max(hi, num))
+
+        def cost(name, num, asc):
+            norm = scoring[name]["norm"] if name in scoring else loading.DEFAULT_NORM
+            if math.isnan(num):
+                return 1.0
+            if norm == loading.NORM_PERCENT:
+                c = min(max(num / 100.0, 0.0), 1.0)
+            elif norm == loading.NORM_NONE:
+                c = num
+            else:
+                lo, hi = ranges[name]
+                c = (num - lo) / (hi - lo) if hi > lo else 0.0
+            if not asc:
+                c = (1.0 - c) if norm != loading.NORM_NONE else -c
+            return c
+
+        recent = self._recent_dispatches()
+        res = []
+        for (s, vitals) in cands:
+            score = sum((scoring[name]["weight"] if name in scoring else loading.DEFAULT_WEIGHT) * cost(name, num, asc) for (name, num, asc) in vitals)
+            res.append((s, score + DISPATCH_PENALTY * recent.get(s, 0)))
+        res.sort(key=lambda e: e[1])
+        return res
 
     def get_best_server(self):
         servers = self.get_servers()
         if len(servers) < 2:
             return servers[0] if servers else None
-        all_vitals = self.get_all_vitals()
-        cur_ix = 0
-        best_s = []
-        best_num = float('nan')
-        while len(best_s) < 2 and cur_ix < len(all_vitals[0][1]):
-            for (s, cur) in all_vitals:
-                _, num, asc = cur[cur_ix]
-                if math.isnan(best_num):
-                    best_s = [ s ]
-                    best_num = num
-                elif num == best_num:
-                    best_s.append(s)
-                else:
-                    if asc:
-                        if num < best_num:
-                            best_s = [ s ]
-                            best_num = num
-                    else:
-                        if num > best_num:
-                            best_s = [ s ]
-                            best_num = num
-            cur_ix += 1
-        return best_s[0] if len(best_s) > 0 else None
+        scores = self.score_servers()
+        return scores[0][0] if scores else None
+
+    def rank_servers(self):
+        """Returns all servers from best to worst score. Servers without
+           vitals or outside of the thresholds come last.
+        """
+        ranked = [ s for (s, _) in self.score_servers() ]
+        return ranked + [ s for s in self.get_servers() if s not in ranked ]
+
+    def _spread(self, num, servers=None):
+        """Assigns num jobs to servers. Each assigned job counts as recently
+           started job for the scores of the following assignments. Without
+           scores the jobs are distributed evenly.
+        """
+        scores = [ (s, score) for (s, score) in self.score_servers() if servers is None or s in servers ]
+        if not scores:
+            targets = list(servers) if servers else self.get_servers()
+            if not targets:
+                raise ValueError("no servers available")
+            return [ targets[ix % len(targets)] for ix in range(num) ]
+        scores = dict(scores)
+        res = []
+        for _ in range(num):
+            s = min(sorted(scores.keys()), key=lambda s: scores[s])
+            scores[s] += DISPATCH_PENALTY
+            res.append(s)
+        return res
 
     _STATUS = dict([
         (RemoteQueue.JOB_DONE, "done"),
@@ -149,94 +652,458 @@ class Connector(object):
         ("error", "error"),
     ])
     def get_all_jobs(self):
+        """Lists the jobs of all servers. The listings run concurrently."""
+        prefix = "{0}_".format(self._project.name)
+        calls = [ (s, self._rq(s).start_list_states(prefix)) for s in self.get_servers() ]
+        res = []
+        for (s, call) in calls:
+            for (j, status, result) in call.wait():
+                status, _ = self._job_state(s, j, status, result)
+                res.append((s, j, status))
+        return res
 
-        def desc(s, j, info):
-            if i["status"] == RemoteQueue.JOB_DONE:
-                if "result" not in i: # FIXME: hack for tej without result in list
-                    return self.get_job_status(s, j)[0]
-                if int(i["result"]) != 0:
-                    return Connector._STATUS["error"]
-            return Connector._STATUS.get(i["status"], "?")
+    def _job_state(self, s, j, status, result):
+        finished = status == RemoteQueue.JOB_DONE
+        if finished:
+            try:
+                if int(result) != 0:
+                    status = "error"
+            except ValueError:
+                status = "error"
+        res = Connector._STATUS.get(status, "?"), result
+        if finished:
+            # finished jobs cannot change anymore
+            with self._lock:
+                self._finished[(s, j)] = res
+        return res
 
-        return [ (s, j, desc(s, j, i)) for s in self.get_servers() for (j, i) in self.get_job_list(s) ]
+    def get_job_states(self, s):
+        """Returns the (job, status, result) tuples of all jobs of the project
+           on the given server using a single remote call.
+        """
+        prefix = "{0}_".format(self._project.name)
+        res = []
+        for (j, status, result) in self._rq(s).list_states(prefix):
+            status, result = self._job_state(s, j, status, result)
+            res.append((j, status, result))
+        return res
 
     def get_job_list(self, s):
         prefix = "{0}_".format(self._project.name)
-        rq = self._rqs[s]
+        rq = self._rq(s)
         return [ ji for ji in loading.list_jobs(rq) if ji[0].startswith(prefix) ]
 
     def get_job_status(self, s, j):
-        rq = self._rqs[s]
+        with self._lock:
+            if (s, j) in self._finished:
+                return self._finished[(s, j)]
+        rq = self._rq(s)
         try:
             status, _, result = rq.status(j)
-            if status == RemoteQueue.JOB_DONE and int(result) != 0:
-                status = "error"
         except JobNotFound:
             status = "missing"
             result = "?"
         except RemoteCommandFailure as rcf:
             status = "error"
             result = rcf.ret
-        return Connector._STATUS.get(status, "?"), result
+        return self._job_state(s, j, status, result)
+
+    def add_job_listener(self):
+        with self._jobs_cond:
+            self._jobs_listeners += 1
+            if self._jobs_thread is None:
+                self._jobs_thread = threading.Thread(target=self._jobs_loop, name="Jobs-{0}".format(self._project.name))
+                self._jobs_thread.daemon = True
+                self._jobs_thread.start()
+            self._jobs_cond.notify_all()
+
+    def remove_job_listener(self):
+        with self._jobs_cond:
+            self._jobs_listeners -= 1
+
+    def wake_jobs(self):
+        self._jobs_wake.set()
+
+    def _jobs_loop(self):
+        while True:
+            with self._jobs_cond:
+                while self._jobs_listeners <= 0:
+                    self._jobs_cond.wait()
+            try:
+                self._update_jobs(self.get_all_jobs())
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                msg("Error polling jobs of {0}:\n{1}", self._project.name, traceback.format_exc())
+            self._jobs_wake.wait(JOBS_POLL_INTERVAL)
+            self._jobs_wake.clear()
+
+    def _update_jobs(self, jobs):
+        cur = dict(((s, j), status) for (s, j, status) in jobs)
+        with self._jobs_cond:
+            changes = [ (s, j, status) for (s, j, status) in jobs if self._jobs.get((s, j)) != status ]
+            removed = [ (s, j) for (s, j) in self._jobs_order if (s, j) not in cur ]
+            if self._jobs_version > 0 and not changes and not removed:
+                return
+            self._jobs = cur
+            self._jobs_order = [ (s, j) for (s, j, _) in jobs ]
+            self._jobs_version += 1
+            self._jobs_history.append((self._jobs_version, changes, removed))
+            del self._jobs_history[:-JOBS_HISTORY]
+            self._jobs_cond.notify_all()
+
+    def wait_jobs(self, version, timeout):
+        """Waits until the job list differs from the given version or timeout
+           seconds have passed. Returns the current version, whether the
+           result contains the full job list, the new or changed jobs as
+           (server, job, status) tuples, and the removed jobs as (server, job)
+           tuples. The job list is polled by one thread per project as long as
+           listeners are registered via add_job_listener.
+        """
+        end = time.time() + timeout
+        with self._jobs_cond:
+            while self._jobs_version == 0 or self._jobs_version == version:
+                left = end - time.time()
+                if left <= 0:
+                    return self._jobs_version, False, [], []
+                self._jobs_cond.wait(left)
+            cur_version = self._jobs_version
+            history = self._jobs_history
+            if version <= 0 or version > cur_version or history[0][0] > version + 1:
+                jobs = [ (s, j, self._jobs[(s, j)]) for (s, j) in self._jobs_order ]
+                return cur_version, True, jobs, []
+            changed = {}
+            for (v, changes, removed) in history:
+                if v <= version:
+                    continue
+                for (s, j, status) in changes:
+                    changed[(s, j)] = status
+                for (s, j) in removed:
+                    changed[(s, j)] = None
+            return (
+                cur_version,
+                False,
+                [ (s, j, status) for ((s, j), status) in changed.items() if status is not None ],
+                [ (s, j) for ((s, j), status) in changed.items() if status is None ],
+            )
+
+    def _load_journal(self):
+        res = {}
+        if not os.path.exists(self._journal_path):
+            return res
+        with open(self._journal_path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue # partially written entry
+                res[e["job"]] = e
+        return res
+
+    def _add_journal(self, entries):
+        """Records the commands of new jobs. The journal is a file of JSON
+           lines next to the project config and maps job ids to commands.
+        """
+        with self._lock:
+            with open(self._journal_path, 'ab') as f:
+                for e in entries:
+                    print(json.dumps(e, sort_keys=True), file=f)
+            for e in entries:
+                self._journal[e["job"]] = e
+
+    def _drop_journal(self, jobs):
+        with self._lock:
+            jobs = [ j for j in jobs if j in self._journal ]
+            if not jobs:
+                return
+            for j in jobs:
+                del self._journal[j]
+            if not self._journal:
+                if os.path.exists(self._journal_path):
+                    os.remove(self._journal_path)
+                return
+            tmp = "{0}.tmp".format(self._journal_path)
+            with open(tmp, 'wb') as f:
+                for e in sorted(self._journal.values(), key=lambda e: e["job"]):
+                    print(json.dumps(e, sort_keys=True), file=f)
+            os.rename(tmp, self._journal_path)
+
+    def get_job_names(self):
+        """Returns a dictionary from job ids to the commands of the jobs."""
+        with self._lock:
+            return dict((j, e["cmd"]) for (j, e) in self._journal.items())
 
     def submit_job(self, s, cmd):
         if not cmd.strip():
             raise ValueError("cannot execute empty command: {0}".format(cmd))
+        rq = self._rq(s)
+        path = self._project.path_local
+        server = self._project.servers[s]
+        mode = transfer.choose_mode(server, path)
         with self._lock:
-            rq = self._rqs[s]
-            path = self._project.path_local
             self._project.add_cmd(cmd)
+        job_name, = new_job_ids(self._project.name, 1)
+        self._add_journal([ { "job": job_name, "cmd": cmd, "server": s, "time": time.time() } ])
+        # indexing counts towards the upload time as the tree mode does not need it
+        start = time.time()
+        try:
+            manifest = self._index.refresh() if transfer.needs_manifest(mode) else None
+            res = transfer.submit(rq, mode, job_name, path, Connector.SCRIPT_FILE, cmd, manifest, transfer.get_compression(server))
+        except:
+            self._drop_journal([ job_name ])
+            raise
+        transfer.record_upload(server, mode, time.time() - start)
+        self._index.set_uploaded(s, manifest)
+        self._note_dispatch(s)
+        self.wake_jobs()
+        return res
 
-            with open(os.path.join(path, Connector.SCRIPT_FILE), 'wb') as f:
-                print(cmd, file=f)
+    def submit_batch(self, template, grid=None, points=None, servers=None):
+        """Submits one job per point of a parameter sweep. The jobs are spread
+           across the given servers or all servers according to their
+           scores. Each server receives the project only once for all of its
+           jobs. Servers are independent of each other. Returns a tuple
+           (jobs, errors) where jobs is a list of (server, job) tuples of all
+           submitted jobs and errors is a list of (server, error) tuples of
+           servers whose submission failed (possibly after some of its jobs
+           had been submitted).
+        """
+        cmds = expand_sweep(template, grid, points)
+        if not cmds:
+            raise ValueError("no parameters given for: {0}".format(template))
+        for cmd in cmds:
+            if not cmd.strip():
+                raise ValueError("cannot execute empty command: {0}".format(cmd))
+        todo = {}
+        for (s, cmd) in zip(self._spread(len(cmds), servers), cmds):
+            todo.setdefault(s, []).append(cmd)
+        path = self._project.path_local
+        with self._lock:
+            self._project.add_cmd(template)
+        modes = dict((s, transfer.choose_mode(self._project.servers[s], path)) for s in todo.keys())
+        needs_manifest = any(transfer.needs_manifest(mode) for mode in modes.values())
+        manifest = self._index.refresh() if needs_manifest else None
 
-            while True:
-                try:
-                    job_name = "{0}_{1}".format(self._project.name, self._job_number)
-                    call = "sh -l ./{0}".format(Connector.SCRIPT_FILE)
-                    return rq.submit(job_name, path, call)
-                except JobAlreadyExists:
-                    pass
-                finally:
-                    self._job_number += 1
+        def submit_all(s):
+            rq = self._rq(s)
+            server = self._project.servers[s]
+            mode = modes[s]
+            cmds = todo[s]
+            jobs = list(zip(new_job_ids(self._project.name, len(cmds)), cmds))
+            now = time.time()
+            self._add_journal([ { "job": j, "cmd": cmd, "server": s, "time": now } for (j, cmd) in jobs ])
+            err = None
+            try:
+                failed = transfer.submit_batch(rq, mode, jobs, path, Connector.SCRIPT_FILE, manifest, transfer.get_compression(server))
+                if failed:
+                    # ids are unique so this only happens if the queue is corrupted
+                    err = JobAlreadyExists(", ".join(failed))
+            except transfer.PartialSubmission as e:
+                failed = [ j for (j, _) in jobs if j not in e.created ]
+                err = e
+            except:
+                self._drop_journal([ j for (j, _) in jobs ])
+                raise
+            self._index.set_uploaded(s, manifest)
+            if failed:
+                self._drop_journal(failed)
+            created = [ j for (j, _) in jobs if j not in failed ]
+            self._note_dispatch(s, len(created))
+            return created, err
 
-    def delete_job(self, s, j):
+        res = []
+        errors = []
+        try:
+            for (s, r, err) in loading.run_parallel(submit_all, sorted(todo.keys())):
+                if err is None:
+                    created, err = r
+                    res.extend((s, j) for j in created)
+                if err is not None:
+                    msg("submitting jobs to {0} failed: {1}", s, err)
+                    errors.append((s, err))
+        finally:
+            self.wake_jobs()
+        return res, errors
+
+    def schedule_jobs(self, template, grid=None, points=None, servers=None):
+        """Queues the commands of a sweep (or just the template if neither
+           grid nor points are given) in the local scheduler. Returns the ids
+           of the queue entries.
+        """
+        cmds = expand_sweep(template, grid, points) if grid or points else [ template ]
         with self._lock:
-            rq = self._rqs[s]
-            loading.kill_job(rq, s, j)
+            self._project.add_cmd(template)
+        return self._scheduler.enqueue(cmds, servers)
 
-    def delete_all_jobs(self):
+    def get_queue(self):
+        return self._scheduler.get_pending()
+
+    def cancel_queued(self, entry_id):
+        return self._scheduler.cancel(entry_id)
+
+    def _forget_jobs(self, s, jobs):
         with self._lock:
-            for (s, j, _) in self.get_all_jobs():
-                self.delete_job(s, j)
+            jobs = set(jobs)
+            for j in jobs:
+                self._finished.pop((s, j), None)
+            for key in [ key for key in self._listings.keys() if key[0] == s and key[1] in jobs ]:
+                self._listings.pop(key, None)
+        self._drop_journal(list(jobs))
+        self.wake_jobs()
+        self._scheduler.wake() # a slot might have become free
 
+    def delete_job(self, s, j):
+        if not loading.kill_job(self._rq(s), s, j):
+            self.wake_jobs()
+            raise ValueError("could not delete job {0} on {1}".format(j, s))
+        self._forget_jobs(s, [ j ])
+
+    def delete_all_jobs(self):
+        """Deletes all jobs of the project with one remote call per server.
+           The servers are processed in parallel.
+        """
+        todo = {}
+        for (s, j, _) in self.get_all_jobs():
+            todo.setdefault(s, []).append(j)
+
+        def kill_all(s):
+            failed = set(j for (j, _) in loading.kill_jobs(self._rq(s), s, todo[s]))
+            self._forget_jobs(s, [ j for j in todo[s] if j not in failed ])
 
-    def get_job_files(self, s, j, rel_path):
-        rq = self._rqs[s]
+        for (s, _, err) in loading.run_parallel(kill_all, sorted(todo.keys())):
+            if err is not None:
+                msg("Error while deleting jobs on {0}: {1}", s, err)
+
+    def _list_dir(self, s, j, rel_path):
+        key = (s, j, rel_path)
+        with self._lock:
+            if key in self._listings:
+                return self._listings[key]
+        rq = self._rq(s)
         status, path, result = rq.status(j)
-        rel_path = PosixPath(rel_path)
-        if rel_path.is_absolute:
-            rel_path = PosixPath(".")
-        res = rq.check_output("ls -p1t {0}".format(str(path / rel_path))).split("\n")
-        if rel_path != ".":
-            res.insert(0, "../")
+        sftp = rq.get_sftp()
+        try:
+            attrs = sftp.listdir_attr(str(path / rel_path))
+        finally:
+            sftp.close()
+        res = []
+        for a in attrs:
+            if stat.S_ISDIR(a.st_mode):
+                ftype = "dir"
+            elif stat.S_ISLNK(a.st_mode):
+                ftype = "link"
+            else:
+                ftype = "file"
+            res.append({
+                "name": a.filename,
+                "type": ftype,
+                "size": a.st_size,
+                "mtime": a.st_mtime,
+            })
+        if status == RemoteQueue.JOB_DONE:
+            # directories of finished jobs do not change anymore
+            with self._lock:
+                self._listings[key] = res
+                while len(self._listings) > LISTINGS_CACHE:
+                    self._listings.popitem(last=False)
         return res
 
+    def get_job_files(self, s, j, rel_path, offset=0, limit=None, sort="mtime", desc=True):
+        """Lists a directory of a job. Returns a tuple (files, total) where
+           files is the requested page of {name, type, size, mtime} dicts
+           sorted by sort and total is the number of all entries.
+        """
+        if sort not in LISTING_SORTS:
+            raise ValueError("unknown sort order '{0}'".format(sort))
+        rel_path = posixpath.normpath(rel_path or ".")
+        if rel_path.startswith("/") or rel_path.split("/")[0] == "..":
+            rel_path = "."
+        files = sorted(self._list_dir(s, j, rel_path), key=lambda f: f[sort], reverse=desc)
+        end = None if limit is None else offset + limit
+        return files[offset:end], len(files)
+
     def get_job_file(self, s, j, req_file):
-        rq = self._rqs[s]
-        status, path, result = rq.status(j)
-        path = PosixPath(loading.DIR_TEMP) / s / j
-        res = str(path / req_file)
-        path_str = os.path.dirname(res)
-        if not os.path.exists(path_str):
-            os.makedirs(path_str)
-        if not os.path.exists(res) or status == RemoteQueue.JOB_RUNNING:
+        """Returns the name of the local copy of a job file after validating
+           it against the size and mtime of the file on the server. Returns
+           None if the job or file does not exist.
+        """
+        rq = self._rq(s)
+        try:
+            status, path, result = rq.status(j)
+        except JobNotFound:
+            return None
+        res = _temp_path(s, j, req_file)
+        remote = str(path / req_file)
+        sftp = rq.get_sftp()
+        try:
             try:
-                rq.download(j, [ req_file ], destination=path_str)
-            except JobNotFound:
+                rst = sftp.stat(remote)
+            except IOError:
+                return None
+            if not stat.S_ISREG(rst.st_mode):
                 return None
+            with loading.key_lock("temp_file", res):
+                path_str = os.path.dirname(res)
+                if not os.path.exists(path_str):
+                    os.makedirs(path_str)
+                _sync_file(sftp, remote, res, rst)
+                _note_temp_file(res)
+        finally:
+            sftp.close()
+        _evict_temp_files(res)
         return res
 
+    def open_job_archive(self, s, j, pattern=None):
+        return loading.open_archive(self._rq(s), j, pattern)
+
+    def open_job_file(self, s, j, req_file, offset=None, length=None, tail=None):
+        """Opens a byte range of a job file. Reading starts at offset or tail
+           bytes before the end of the file and stops after length bytes or
+           at the end of the file. The file is streamed from the server via
+           SFTP unless local copies are enabled. Returns a tuple (f, start,
+           length, size) where f is a RangeReader and size is the current
+           size of the file or None if the job or file does not exist.
+        """
+        if LOCAL_COPIES:
+            local = _temp_path(s, j, req_file)
+            # the copy must not be evicted while it is served
+            _use_temp_file(local)
+            try:
+                filename = self.get_job_file(s, j, req_file)
+                if filename is None or not os.path.isfile(filename):
+                    _release_temp_file(local)
+                    return None
+                f = open(filename, 'rb')
+            except:
+                _release_temp_file(local)
+                raise
+            size = os.fstat(f.fileno()).st_size
+            start, length = _get_range(size, offset, length, tail)
+            f.seek(start)
+            return RangeReader(f, length, lambda: _release_temp_file(local)), start, length, size
+        rq = self._rq(s)
+        try:
+            status, path, result = rq.status(j)
+        except JobNotFound:
+            return None
+        sftp = rq.get_sftp()
+        try:
+            f = sftp.open(str(path / req_file), 'rb')
+        except IOError:
+            sftp.close()
+            return None
+        try:
+            size = f.stat().st_size
+            start, length = _get_range(size, offset, length, tail)
+            f.seek(start)
+        except:
+            f.close()
+            sftp.close()
+            raise
+        return RangeReader(f, length, sftp.close), start, length, size
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Parcell Connector')
     parser.add_argument('--reuse-pw', action='store_true', dest='reuse_pw', help="only ask for one password")
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import stat
+import time
+import fnmatch
+import hashlib
+import threading
+
+import loading
+
+IGNORE_FILE = ".parcellignore"
+DIR_MARKER = "-"
+BLOCK_SIZE = 1 << 20
+INDEX_TTL = 5
+
+def msg(message, *args, **kwargs):
+    print(message.format(*args, **kwargs), file=sys.stdout)
+
+def set_msg(m):
+    global msg
+    msg = m
+
+def _hash_file(full_path):
+    h = hashlib.sha1()
+    with open(full_path, 'rb') as f:
+        while True:
+            buff = f.read(BLOCK_SIZE)
+            if not buff:
+                break
+            h.update(buff)
+    return h.hexdigest()
+
+def read_ignore(path):
+    """Reads the ignore patterns of a project. Every line is a glob pattern.
+       Patterns ending in '/' only match directories. Patterns containing a
+       '/' are matched against the path relative to the project and all
+       other patterns against file names. Lines starting with '#' are
+       comments.
+    """
+    full = os.path.join(path, IGNORE_FILE)
+    if not os.path.exists(full):
+        return []
+    res = []
+    with open(full, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            res.append((line.lstrip("/"), dir_only, "/" in line))
+    return res
+
+def is_ignored(patterns, rel, is_dir):
+    name = rel.rsplit("/", 1)[-1]
+    for (pattern, dir_only, full) in patterns:
+        if dir_only and not is_dir:
+            continue
+        if fnmatch.fnmatchcase(rel if full else name, pattern):
+            return True
+    return False
+
+class ProjectIndex(object):
+    """A persistent index of the files of a project. For every file the
+       size, mtime, inode and content hash are stored so that only files
+       whose stat changed have to be hashed again. The index also remembers
+       the state of the last upload to each server to report changes since
+       then. It is stored next to the project config.
+    """
+    def __init__(self, name, path, skip=()):
+        self._path = path
+        self._skip = set(skip)
+        self._index_path = loading.get_index_path(name)
+        self._lock = threading.RLock()
+        self._files = {}
+        self._uploads = {}
+        self._manifest = None
+        self._refreshed = None
+        self._pending = set()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._index_path):
+            return
+        try:
+            with open(self._index_path, 'rb') as f:
+                obj = json.load(f)
+        except ValueError:
+            msg("ignoring broken index {0}", self._index_path)
+            return
+        self._files = dict((rel, tuple(e)) for (rel, e) in obj.get("files", {}).items())
+        self._uploads = obj.get("uploads", {})
+
+    def _save(self):
+        tmp = "{0}.tmp".format(self._index_path)
+        with open(tmp, 'wb') as f:
+            json.dump({
+                "files": self._files,
+                "uploads": self._uploads,
+            }, f, separators=(',', ':'), sort_keys=True)
+        os.rename(tmp, self._index_path)
+
+    @property
+    def path(self):
+        return self._path
+
+    def refresh(self, max_age=None):
+        """Updates the index from the project directory. Returns the manifest
+           of the project, i.e., a list of (blob, rel_path) tuples in top-down
+           order and a dictionary from blobs to full paths. Directories have
+           DIR_MARKER as blob and files the hash of their content with an 'x'
+           appended for executables. If max_age is given and the last refresh
+           is more recent, the directory is not read again.
+        """
+        with self._lock:
+            if max_age is not None and self._refreshed is not None and time.time() - self._refreshed < max_age:
+                return self._manifest
+            patterns = read_ignore(self._path)
+            old = self._files
+            files = {}
+            res = []
+            blobs = {}
+            chg = False
+            for (root, dirs, fnames) in os.walk(self._path, followlinks=True):
+                rel_root = os.path.relpath(root, self._path)
+                rel_root = "" if rel_root == "." else rel_root.replace(os.sep, "/") + "/"
+                dirs[:] = sorted(d for d in dirs if not is_ignored(patterns, rel_root + d, True))
+                if rel_root:
+                    res.append((DIR_MARKER, rel_root[:-1]))
+                for fname in sorted(fnames):
+                    rel = rel_root + fname
+                    if rel in self._skip or is_ignored(patterns, rel, False):
+                        continue
+                    if "\n" in rel:
+                        raise ValueError("cannot index file with newline in its name: {0!r}".format(rel))
+                    full = os.path.join(root, fname)
+                    st = os.stat(full)
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    key = (st.st_size, st.st_mtime, st.st_ino)
+                    known = old.get(rel)
+                    if known is not None and tuple(known[:3]) == key:
+                        blob = known[3]
+                    else:
+                        blob = _hash_file(full)
+                        chg = True
+                    files[rel] = key + (blob, )
+                    if st.st_mode & stat.S_IXUSR:
+                        blob += "x"
+                    res.append((blob, rel))
+                    blobs[blob] = full
+            self._files = files
+            self._manifest = (res, blobs)
+            self._refreshed = time.time()
+            pending, self._pending = self._pending, set()
+            for server in pending:
+                self._set_uploaded(server, self._manifest)
+            if chg or len(files) != len(old) or pending:
+                self._save()
+            return self._manifest
+
+    def set_uploaded(self, server, manifest=None):
+        """Records the manifest as the state of the project on the server. If
+           no manifest is given the state of the next refresh is recorded.
+        """
+        with self._lock:
+            if manifest is None:
+                self._pending.add(server)
+                return
+            self._pending.discard(server)
+            self._set_uploaded(server, manifest)
+            self._save()
+
+    def _set_uploaded(self, server, manifest):
+        self._uploads[server] = dict((rel, blob) for (blob, rel) in manifest[0] if blob != DIR_MARKER)
+
+    def get_changes(self, server):
+        """Counts the files that changed since the last upload to the server
+           as of the last refresh. The directory is not read. Returns a
+           dictionary with the number of new or modified files, their size
+           in bytes, the number of removed files, and whether there was an
+           upload at all or None if the index has not been refreshed yet.
+        """
+        with self._lock:
+            manifest = self._manifest
+            if manifest is None:
+                return None
+            uploaded = self._uploads.get(server)
+            known = uploaded is not None
+            uploaded = uploaded or {}
+            num = 0
+            size = 0
+            cur = set()
+            for (blob, rel) in manifest[0]:
+                if blob == DIR_MARKER:
+                    continue
+                cur.add(rel)
+                if uploaded.get(rel) != blob:
+                    num += 1
+                    size += self._files[rel][0]
+            return {
+                "files": num,
+                "bytes": size,
+                "removed": len([ rel for rel in uploaded if rel not in cur ]),
+                "uploaded": known,
+            }
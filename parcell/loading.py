@@ -10,8 +10,11 @@ import json
 import time
 import atexit
 import base64
+import select
 import shutil
+import socket
 import getpass
+import tarfile
 import hashlib
 import binascii
 import paramiko
@@ -19,8 +22,12 @@ import threading
 import traceback
 from rpaths import PosixPath
 from tej import RemoteQueue, parse_ssh_destination, QueueDoesntExist, RemoteCommandFailure, JobNotFound
+from tej.submission import check_jobid
+from tej.utils import shell_escape
 
-from tunnel import start_tunnel, check_tunnel, check_permission_denied
+from tunnel import start_tunnel, check_tunnel, check_permission_denied, wait_tunnel, \
+                   open_channel, TUNNEL_ENGINES, TUNNEL_ENGINE_DEFAULT, \
+                   TUNNEL_ENGINE_SSH, TUNNEL_ENGINE_PARAMIKO
 
 def simple_msg(message, *args, **kwargs):
     print(message.format(*args, **kwargs), file=sys.stdout)
@@ -32,6 +39,31 @@ def set_msg(m):
 
 MAIN_LOCK = threading.RLock()
 
+_KEY_LOCKS_LOCK = threading.Lock()
+_KEY_LOCKS = {}
+def key_lock(kind, key):
+    """Returns the lock guarding the given key (e.g., one server or one
+       project). Only requests for the same key block each other.
+    """
+    with _KEY_LOCKS_LOCK:
+        lock = _KEY_LOCKS.get((kind, key))
+        if lock is None:
+            lock = threading.RLock()
+            _KEY_LOCKS[(kind, key)] = lock
+        return lock
+
+def get_cached(cache, kind, key, create):
+    """Returns cache[key] creating it via create(key) if necessary. The fast
+       path does not lock at all and creation is serialized per key.
+    """
+    res = cache.get(key)
+    if res is not None:
+        return res
+    with key_lock(kind, key):
+        if key not in cache:
+            cache[key] = create(key)
+        return cache[key]
+
 DEFAULT_BASE = os.path.dirname(__file__)
 DIR_ENV_DEFAULT = os.path.join(DEFAULT_BASE, "default_envs")
 DIR_ENV = "envs"
@@ -39,14 +71,46 @@ DIR_SERVER = "servers"
 DIR_PROJECT = "projects"
 DIR_TEMP = "temp_files"
 EXT = ".json"
+EXT_QUEUE = ".queue"
+EXT_JOURNAL = ".jobs"
+EXT_INDEX = ".index"
 
 DIR_REMOTE_TEJ = "~/.parcell"
+# shared project snapshots inside the remote queue
+DIR_REMOTE_VERSIONS = "versions"
+EXT_REMOTE_REFS = ".refs"
+# shell functions serializing the creation and removal of snapshot
+# references -- locks left behind by killed processes expire after a minute
+REMOTE_VERSIONS_LOCK = """
+lock_versions() {{
+    mkdir -p {0}
+    tries=0
+    while ! mkdir {0}/.lock 2>/dev/null; do
+        tries=$((tries + 1))
+        if [ $((tries % 50)) -eq 0 ]; then
+            find {0}/.lock -maxdepth 0 -mmin +1 -exec rmdir {{}} \\; 2>/dev/null || true
+        fi
+        sleep 0.1
+    done
+}}
+unlock_versions() {{
+    rmdir {0}/.lock
+}}
+""".format(DIR_REMOTE_VERSIONS)
 
 LOCALHOST = "127.0.0.1"
 
 DEFAULT_REGEX = "(.*)"
 DEFAULT_LINE = 0
 
+# normalizations of vitals for scoring servers
+NORM_RANGE = "range" # relative to the best and worst server
+NORM_PERCENT = "percent" # the value is a percentage
+NORM_NONE = "none" # the value is used as is
+NORMS = [ NORM_RANGE, NORM_PERCENT, NORM_NONE ]
+DEFAULT_NORM = NORM_RANGE
+DEFAULT_WEIGHT = 1.0
+
 UPGRADE_ENV = []
 UPGRADE_SERVER = []
 UPGRADE_PROJECT = []
@@ -82,6 +146,18 @@ def get_projects(no_default=False):
 def _get_path(path, name):
     return os.path.join(path, "{0}{1}".format(name, EXT))
 
+def get_queue_path(project):
+    return os.path.join(DIR_PROJECT, "{0}{1}".format(project, EXT_QUEUE))
+
+def get_journal_path(project):
+    return os.path.join(DIR_PROJECT, "{0}{1}".format(project, EXT_JOURNAL))
+
+def get_index_path(project):
+    return os.path.join(DIR_PROJECT, "{0}{1}".format(project, EXT_INDEX))
+
+def get_queued_projects():
+    return [ p for p in get_projects(no_default=True) if os.path.exists(get_queue_path(p)) ]
+
 def _write_json(path, obj):
     with open(path, 'wb') as f:
         json.dump(obj, f, indent=2, sort_keys=True)
@@ -277,9 +353,21 @@ class EnvConfig(Config):
                         res.append((name, cmd, regex, line))
             return res
 
+        def get_scoring(e):
+            norm = e.get("norm", DEFAULT_NORM)
+            if norm not in NORMS:
+                raise ValueError("unknown normalization '{0}' for vital {1}".format(norm, e["name"]))
+            threshold = e.get("threshold", None)
+            return {
+                "weight": float(e.get("weight", DEFAULT_WEIGHT)),
+                "norm": norm,
+                "threshold": float(threshold) if threshold is not None else None,
+            }
+
         return {
             "versions": get("versions", True),
             "vital": get("vital", False),
+            "scoring": dict((e["name"], get_scoring(e)) for e in obj.get("vital", [])),
         }
 
     def write_object(self, obj):
@@ -302,6 +390,14 @@ class EnvConfig(Config):
                 res["regex"] = regex.pattern
             if line != DEFAULT_LINE:
                 res["line"] = line
+            if not version:
+                scoring = obj["scoring"][name]
+                if scoring["weight"] != DEFAULT_WEIGHT:
+                    res["weight"] = scoring["weight"]
+                if scoring["norm"] != DEFAULT_NORM:
+                    res["norm"] = scoring["norm"]
+                if scoring["threshold"] is not None:
+                    res["threshold"] = scoring["threshold"]
             return res
 
         return {
@@ -319,17 +415,20 @@ def up_e0(obj):
 
 ALL_ENVS = {}
 def get_env(e):
-    with MAIN_LOCK:
-        if e not in ALL_ENVS:
-            ALL_ENVS[e] = EnvConfig(e)
-        return ALL_ENVS[e]
+    return get_cached(ALL_ENVS, "env", e, EnvConfig)
 
 SERVER_SKIP_KEYS = frozenset([
     "needs_pw",
     "tunnel",
     "tunnel_port",
+    "tunnel_engine",
     "needs_tunnel_pw",
     "key",
+    "upload",
+    "compression",
+    "compression_level",
+    "slots",
+    "thresholds",
     "version",
 ])
 class ServerConfig(Config):
@@ -353,11 +452,23 @@ class ServerConfig(Config):
 
     def get_destination_obj(self, front):
         res = self.get_obj(SERVER_SKIP_KEYS)
-        if front and "tunnel_port" in self:
+        # the built-in tunnel connects to the actual destination
+        if front and "tunnel_port" in self and self.needs_tunnel_process():
             res["hostname"] = LOCALHOST
             res["port"] = self["tunnel_port"]
         return res
 
+    def get_tunnel_engine(self):
+        if "tunnel" not in self:
+            return None
+        engine = self.get("tunnel_engine", TUNNEL_ENGINE_DEFAULT)
+        if engine not in TUNNEL_ENGINES:
+            raise ValueError("unknown tunnel engine '{0}' for {1}".format(engine, self._name))
+        return engine
+
+    def needs_tunnel_process(self):
+        return self.get_tunnel_engine() == TUNNEL_ENGINE_SSH
+
     def __setitem__(self, key, value):
         chg = self.has_change()
         super(ServerConfig, self).__setitem__(key, value)
@@ -398,10 +509,7 @@ def up_s0(obj):
 
 ALL_SERVERS = {}
 def get_server(s):
-    with MAIN_LOCK:
-        if s not in ALL_SERVERS:
-            ALL_SERVERS[s] = ServerConfig(s)
-        return ALL_SERVERS[s]
+    return get_cached(ALL_SERVERS, "server", s, ServerConfig)
 
 class ProjectConfig(Config):
 
@@ -455,6 +563,12 @@ class ProjectConfig(Config):
     def servers(self):
         return dict( (s.name, s) for s in self["servers"] )
 
+    def delete_file(self):
+        for path in [ get_queue_path(self.name), get_journal_path(self.name), get_index_path(self.name) ]:
+            if os.path.exists(path):
+                os.remove(path)
+        super(ProjectConfig, self).delete_file()
+
 @upgrade(UPGRADE_PROJECT, 0)
 def up_p0(obj):
     obj["cmds"] = [ obj["cmd"] ]
@@ -463,10 +577,7 @@ def up_p0(obj):
 
 ALL_PROJECTS = {}
 def get_project(p):
-    with MAIN_LOCK:
-        if p not in ALL_PROJECTS:
-            ALL_PROJECTS[p] = ProjectConfig(p)
-        return ALL_PROJECTS[p]
+    return get_cached(ALL_PROJECTS, "project", p, ProjectConfig)
 
 def _get_tunnel_ports():
     sobjs = [ get_server(n) for n in get_servers() ]
@@ -481,7 +592,12 @@ _GLOBAL_PASSWORD = None
 _ALL_PWS = {}
 _ASK_REUSE = True
 _ASK_REUSE_PRIMED = None
+_PW_LOCK = threading.RLock()
 def ask_password(user, address):
+    with _PW_LOCK:
+        return _ask_password(user, address)
+
+def _ask_password(user, address):
     global _GLOBAL_PASSWORD
     global _ASK_REUSE
     global _ASK_REUSE_PRIMED
@@ -511,15 +627,18 @@ def ask_password(user, address):
         _ALL_PWS[pw_id] = res
     return _ALL_PWS[pw_id]
 
+def _get_tunnel_dest(server):
+    tunnel = parse_ssh_destination(server["tunnel"])
+    if "password" in tunnel:
+        raise ValueError("tunnel password should not be stored in config! {0}@{1}:{2}".format(tunnel["username"], tunnel["hostname"], tunnel["port"]))
+    if server.get("needs_tunnel_pw", False):
+        tunnel["password"] = ask_password(tunnel["username"], tunnel["hostname"])
+    return tunnel
+
 def _setup_tunnel(server):
-    with MAIN_LOCK:
-        s = server.name
-        tunnel = parse_ssh_destination(server["tunnel"])
-        if "password" in tunnel:
-            raise ValueError("tunnel password should not be stored in config! {0}@{1}:{2}".format(tunnel["username"], tunnel["hostname"], tunnel["port"]))
-        if server.get("needs_tunnel_pw", False):
-            tunnel["password"] = ask_password(tunnel["username"], tunnel["hostname"])
-        start_tunnel(s, tunnel, server.get_destination_obj(False), server["tunnel_port"])
+    with key_lock("server", server.name):
+        tunnel = _get_tunnel_dest(server)
+        start_tunnel(server.name, tunnel, server.get_destination_obj(False), server["tunnel_port"])
 
 class LocalAddPolicy(paramiko.client.MissingHostKeyPolicy):
 
@@ -533,6 +652,332 @@ class LocalAddPolicy(paramiko.client.MissingHostKeyPolicy):
             hostname = server["hostname"]
         server.check_key(hostname, key.get_name(), key.get_base64(), binascii.hexlify(key.get_fingerprint()))
 
+POOL_SIZE = 4
+POOL_KEEPALIVE = 30
+POOL_RETRIES = 5
+POOL_BACKOFF_START = 1
+POOL_BACKOFF_MAX = 30
+class SSHPool(object):
+    """A pool of SSH connections to one server. Connections are opened on
+       demand up to the pool size and shared once all of them are in use.
+       Dead connections are dropped and replaced transparently with an
+       exponential backoff between failed connection attempts.
+    """
+
+    def __init__(self, name, connect, size=POOL_SIZE):
+        self._name = name
+        self._connect = connect
+        self._size = size
+        self._cond = threading.Condition()
+        self._entries = []
+        self._connecting = 0
+
+    def _is_alive(self, entry):
+        transport = entry[0].get_transport()
+        return transport is not None and transport.is_active()
+
+    def _drop(self, entry):
+        if entry in self._entries:
+            self._entries.remove(entry)
+        try:
+            entry[0].close()
+        except:
+            pass
+
+    def _open(self):
+        delay = POOL_BACKOFF_START
+        tries = 0
+        while True:
+            try:
+                client = self._connect()
+                client.get_transport().set_keepalive(POOL_KEEPALIVE)
+                return client
+            except paramiko.ssh_exception.AuthenticationException:
+                raise
+            except (socket.error, paramiko.SSHException, EOFError) as e:
+                tries += 1
+                if tries >= POOL_RETRIES:
+                    raise
+                msg("Connecting to {0} failed ({1}) -- retry in {2}s", self._name, e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, POOL_BACKOFF_MAX)
+
+    def add(self, client):
+        client.get_transport().set_keepalive(POOL_KEEPALIVE)
+        with self._cond:
+            self._entries.append([ client, 0 ])
+            self._cond.notify_all()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                for entry in list(self._entries):
+                    if entry[1] == 0 and not self._is_alive(entry):
+                        self._drop(entry)
+                alive = [ e for e in self._entries if self._is_alive(e) ]
+                best = min(alive, key=lambda e: e[1]) if alive else None
+                can_open = len(self._entries) + self._connecting < self._size
+                if best is not None and (best[1] == 0 or not can_open):
+                    best[1] += 1
+                    return best
+                if can_open:
+                    self._connecting += 1
+                    break
+                self._cond.wait()
+        try:
+            entry = [ self._open(), 1 ]
+        finally:
+            with self._cond:
+                self._connecting -= 1
+                self._cond.notify_all()
+        with self._cond:
+            self._entries.append(entry)
+        return entry
+
+    def release(self, entry, broken=False):
+        with self._cond:
+            entry[1] -= 1
+            if broken or not self._is_alive(entry):
+                entry[1] = max(entry[1], 0)
+                if entry[1] == 0:
+                    self._drop(entry)
+            self._cond.notify_all()
+
+    def get_client(self):
+        entry = self.acquire()
+        self.release(entry)
+        return entry[0]
+
+    def close(self):
+        with self._cond:
+            for entry in list(self._entries):
+                self._drop(entry)
+
+CHUNK_SIZE = 1 << 16
+class CommandOutput(object):
+    """A file like object streaming the standard output of a remote command.
+       Messages on standard error are passed to the server logger.
+    """
+    def __init__(self, chan, server_err, on_close):
+        self._chan = chan
+        self._server_err = server_err
+        self._on_close = on_close
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(iter(lambda: self.read(CHUNK_SIZE), ''))
+        while self._chan.recv_stderr_ready():
+            self._server_err.append(self._chan.recv_stderr(1024))
+        buff = self._chan.recv(size)
+        self._pos += len(buff)
+        return buff
+
+    def tell(self):
+        return self._pos
+
+    def exit_status(self):
+        return self._chan.recv_exit_status()
+
+    def close(self):
+        if self._chan is None:
+            return
+        try:
+            self._chan.close()
+            self._server_err.done()
+        finally:
+            self._chan = None
+            self._on_close()
+
+class RemoteCall(object):
+    """A running remote command. Its output is collected by the reactor so
+       that waiting for many commands does not need one thread per command.
+       wait blocks until the command has finished and returns the result of
+       parse(exit status, output).
+    """
+    def __init__(self, chan, server_err, on_done, get_output, parse=None):
+        self._chan = chan
+        self._server_err = server_err
+        self._on_done = on_done
+        self._get_output = get_output
+        self._parse = parse if parse is not None else lambda ret, output: (ret, output)
+        self._output = []
+        self._ret = None
+        self._error = None
+        self._event = threading.Event()
+
+    @staticmethod
+    def completed(value):
+        res = RemoteCall(None, None, None, False, lambda ret, output: value)
+        res._event.set()
+        return res
+
+    def fileno(self):
+        return self._chan.fileno()
+
+    def _pump(self):
+        """Reads all available data and returns whether the command has
+           finished.
+        """
+        recvd = False
+        while self._chan.recv_stderr_ready():
+            self._server_err.append(self._chan.recv_stderr(1024))
+            recvd = True
+        while self._chan.recv_ready():
+            buff = self._chan.recv(4096)
+            if self._get_output:
+                self._output.append(buff)
+            recvd = True
+        return not recvd and self._chan.exit_status_ready()
+
+    def _finish(self, error=None):
+        try:
+            if error is None:
+                self._ret = self._chan.recv_exit_status()
+        except Exception as e:
+            error = e
+        finally:
+            self._error = error
+            try:
+                self._chan.close()
+                self._server_err.done()
+            finally:
+                self._on_done(error is not None)
+                self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self._event.is_set():
+            if deadline is not None and time.time() >= deadline:
+                break
+            # makes sure the reactor is still there to finish the call
+            get_reactor().check()
+            self._event.wait(1 if deadline is None else max(0, min(1, deadline - time.time())))
+        if not self._event.is_set():
+            raise RemoteTimeout("remote call took longer than {0}s".format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._parse(self._ret, ''.join(self._output).rstrip('\r\n'))
+
+class Reactor(object):
+    """Collects the output of all running remote commands in a single
+       thread using poll (or select where poll is not available). Errors
+       only fail the affected calls and a dead thread is restarted.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._new = []
+        self._thread = None
+        self._wake_r, self._wake_w = os.pipe()
+
+    def add(self, call):
+        with self._lock:
+            self._new.append(call)
+            self._ensure_thread()
+        os.write(self._wake_w, "x")
+
+    def check(self):
+        with self._lock:
+            self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._thread is not None:
+            msg("restarting remote call reactor")
+        self._thread = threading.Thread(target=self._loop, name="Reactor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _finish(self, call, err):
+        try:
+            call._finish(err)
+        except:
+            msg("Error finishing remote call:\n{0}", traceback.format_exc())
+
+    def _new_poller(self):
+        if not hasattr(select, "poll"):
+            return None
+        poller = select.poll()
+        poller.register(self._wake_r, select.POLLIN)
+        with self._lock:
+            fds = list(self._calls.keys())
+        for fd in fds:
+            poller.register(fd, select.POLLIN)
+        return poller
+
+    def _loop(self):
+        poller = self._new_poller()
+        while True:
+            try:
+                self._step(poller)
+            except Exception as e:
+                msg("Error in remote call reactor:\n{0}", traceback.format_exc())
+                with self._lock:
+                    calls = list(self._calls.values())
+                    self._calls = {}
+                for call in calls:
+                    self._finish(call, e)
+                poller = self._new_poller()
+
+    def _step(self, poller):
+        with self._lock:
+            new, self._new = self._new, []
+        for call in new:
+            try:
+                fd = call.fileno()
+                if poller is not None:
+                    poller.register(fd, select.POLLIN)
+            except Exception as e:
+                self._finish(call, e)
+                continue
+            with self._lock:
+                self._calls[fd] = call
+        if poller is not None:
+            ready = poller.poll()
+        else:
+            with self._lock:
+                fds = list(self._calls.keys())
+            r, _, _ = select.select([ self._wake_r ] + fds, [], [])
+            ready = [ (fd, 0) for fd in r ]
+        for (fd, ev) in ready:
+            if fd == self._wake_r:
+                os.read(self._wake_r, 4096)
+                continue
+            with self._lock:
+                call = self._calls.get(fd)
+            if call is None:
+                continue
+            err = None
+            try:
+                if poller is not None and ev & select.POLLNVAL:
+                    raise IOError("remote call channel was closed")
+                finished = call._pump()
+            except Exception as e:
+                finished, err = True, e
+            if finished:
+                with self._lock:
+                    self._calls.pop(fd, None)
+                if poller is not None:
+                    poller.unregister(fd)
+                self._finish(call, err)
+
+_REACTOR = None
+_REACTOR_LOCK = threading.Lock()
+def get_reactor():
+    global _REACTOR
+    with _REACTOR_LOCK:
+        if _REACTOR is None:
+            _REACTOR = Reactor()
+        return _REACTOR
+
+# seconds running jobs get to terminate before they are killed
+KILL_GRACE = 3
+
 class TunnelableRemoteQueue(RemoteQueue):
 
     def __init__(self, *args, **kwargs):
@@ -546,38 +991,243 @@ class TunnelableRemoteQueue(RemoteQueue):
          ssh.set_missing_host_key_policy(LocalAddPolicy(self.s_obj))
          return ssh
 
+    def _new_client(self):
+        ssh = self._ssh_client()
+        dest = self.destination
+        if self.s_obj.get_tunnel_engine() == TUNNEL_ENGINE_PARAMIKO:
+            dest = dict(dest)
+            dest["sock"] = open_channel(_get_tunnel_dest(self.s_obj), dest)
+        ssh.connect(**dest)
+        return ssh
+
+    def _connect(self):
+        # called from the RemoteQueue constructor -- the first connection is
+        # opened directly so connection errors reach the caller immediately
+        self._pool = SSHPool(self.s_obj.name, self._new_client)
+        self._ssh = self._new_client()
+        self._pool.add(self._ssh)
+
+    def get_client(self):
+        self._ssh = self._pool.get_client()
+        return self._ssh
+
+    def start_call(self, cmd, data=None, get_output=True, parse=None):
+        """Starts a command and returns a RemoteCall without waiting for the
+           command to finish. data is fed to the stdin of the command and can
+           also be a function that gets called with a write function to stream
+           the input.
+        """
+        server_err = self.server_logger()
+        entry = self._pool.acquire()
+        try:
+            try:
+                chan = entry[0].get_transport().open_session()
+            except (socket.error, paramiko.SSHException, EOFError):
+                # the connection died -- nothing has been executed yet
+                broken, entry = entry, None
+                self._pool.release(broken, broken=True)
+                entry = self._pool.acquire()
+                chan = entry[0].get_transport().open_session()
+            try:
+                chan.exec_command('/bin/sh -c {0}'.format(shell_escape(cmd)))
+                if callable(data):
+                    try:
+                        data(chan.sendall)
+                        chan.shutdown_write()
+                    except socket.error:
+                        # the command might have stopped reading early
+                        if not chan.exit_status_ready():
+                            raise
+                elif data is not None:
+                    chan.sendall(data)
+                    chan.shutdown_write()
+            except:
+                chan.close()
+                raise
+        except:
+            server_err.done()
+            if entry is not None:
+                self._pool.release(entry)
+            raise
+        pool_entry = entry
+        call = RemoteCall(chan, server_err, lambda broken: self._pool.release(pool_entry, broken), get_output, parse)
+        get_reactor().add(call)
+        return call
+
+    def _exec(self, cmd, data, get_output):
+        return self.start_call(cmd, data, get_output).wait()
+
+    def _call(self, cmd, get_output):
+        return self._exec(cmd, None, get_output)
+
+    def open_output(self, cmd):
+        """Executes a command and returns its standard output as a file like
+           CommandOutput. The connection stays leased until it is closed.
+        """
+        entry = self._pool.acquire()
+        try:
+            chan = entry[0].get_transport().open_session()
+            chan.exec_command('/bin/sh -c {0}'.format(shell_escape(cmd)))
+        except:
+            self._pool.release(entry, broken=True)
+            raise
+        return CommandOutput(chan, self.server_logger(), lambda: self._pool.release(entry))
+
+    def get_queue(self):
+        queue = self._get_queue()
+        if queue is None:
+            queue = self._setup()
+        return queue
+
+    def list_states(self, prefix):
+        """Lists all jobs starting with prefix in a single remote call.
+           Returns (job, status, result) tuples where result is the exit code
+           of finished jobs and None otherwise.
+        """
+        return self.start_list_states(prefix).wait()
+
+    def start_list_states(self, prefix):
+        queue = self._get_queue()
+        if queue is None:
+            return RemoteCall.completed([])
+        cmd = """
+cd {0}/jobs || exit 0
+for job in {1}*; do
+    [ -d "$job" ] || continue
+    status="{2}"
+    arg=""
+    if [ -f "$job/status" ]; then
+        {{ read status; read arg; }} < "$job/status"
+    fi
+    echo "$job $status $arg"
+done
+""".format(shell_escape(queue), shell_escape(prefix), RemoteQueue.JOB_INCOMPLETE)
+
+        def parse(ret, output):
+            if ret != 0:
+                raise RemoteCommandFailure(command="list states", ret=ret)
+            res = []
+            for line in output.split("\n"):
+                if not line.strip():
+                    continue
+                parts = line.split(" ", 2)
+                job, status = parts[0], parts[1]
+                result = parts[2].strip() if len(parts) > 2 else ""
+                res.append((job, status, result if status == RemoteQueue.JOB_DONE else None))
+            return res
+
+        return self.start_call(cmd, parse=parse)
+
+    def kill_jobs(self, jobs):
+        """Kills and deletes all given jobs in a single remote call. Running
+           jobs get TERM and, after KILL_GRACE seconds for all of them
+           together, KILL. Shared project snapshots that are not used by any
+           job anymore are removed as well. Returns (job, code) tuples of jobs
+           that could not be deleted.
+        """
+        queue = self._get_queue()
+        if queue is None or not jobs:
+            return []
+        for j in jobs:
+            check_jobid(j)
+        ret, output = self.call_input("""
+cd {0} || exit 1
+jobs="$(mktemp)"
+trap 'rm -f "$jobs"' EXIT
+cat > "$jobs"
+pids=""
+while read -r job; do
+    [ -f "jobs/$job/status" ] || continue
+    {{ read status; read arg; }} < "jobs/$job/status"
+    if [ "$status" = running ] && kill -TERM "$arg" 2>/dev/null; then
+        pids="$pids $arg"
+    fi
+done < "$jobs"
+if [ -n "$pids" ]; then
+    sleep {3}
+    killed=""
+    for pid in $pids; do
+        kill -KILL "$pid" 2>/dev/null && killed=1
+    done
+    # gives the job wrappers time to record the exit
+    [ -z "$killed" ] || sleep 1
+fi
+while read -r job; do
+    commands/delete "$job" >/dev/null 2>&1
+    ret=$?
+    if [ $ret -ne 0 ] && [ $ret -ne 3 ]; then
+        echo "$job $ret"
+    else
+        rm -f {1}/*{2}/"$job"
+    fi
+done < "$jobs"
+{4}
+for refs in {1}/*{2}; do
+    [ -d "$refs" ] || continue
+    version="${{refs%{2}}}"
+    lock_versions
+    if rmdir "$refs" 2>/dev/null; then
+        mv "$version" "$version.gc.$$" 2>/dev/null || true
+    fi
+    unlock_versions
+    rm -rf "$version.gc.$$"
+done
+exit 0
+""".format(shell_escape(queue), DIR_REMOTE_VERSIONS, EXT_REMOTE_REFS, KILL_GRACE, REMOTE_VERSIONS_LOCK), "".join("{0}\n".format(j) for j in jobs))
+        if ret != 0:
+            raise RemoteCommandFailure(command="kill jobs", ret=ret)
+        res = []
+        for line in output.split("\n"):
+            if not line.strip():
+                continue
+            job, code = line.strip().split(" ", 1)
+            res.append((job, int(code)))
+        return res
+
+    def get_sftp(self):
+        return self.get_client().open_sftp()
+
+    def call_input(self, cmd, data):
+        """Calls a command through SSH while feeding data to its stdin. data
+           can also be a function that gets called with a write function to
+           stream the input. Returns the exit status and the output of the
+           command.
+        """
+        return self._exec(cmd, data, True)
+
 ALL_REMOTES = {}
 def get_remote(server):
-    with MAIN_LOCK:
-        s = server.name
-        if "tunnel" in server and not check_tunnel(s):
+    s = server.name
+    res = ALL_REMOTES.get(s)
+    if res is not None and (not server.needs_tunnel_process() or check_tunnel(s)):
+        return res
+    with key_lock("server", s):
+        if server.needs_tunnel_process() and not check_tunnel(s):
             _setup_tunnel(server)
         if s not in ALL_REMOTES:
             if server.get("needs_pw", False) and "password" not in server:
                 raise ValueError("no password found in {0}".format(s))
             remote_dir = "{0}_{1}".format(DIR_REMOTE_TEJ, s)
             dest = server.get_destination_obj(True)
-            while s not in ALL_REMOTES:
-                try:
-                    ALL_REMOTES[s] = TunnelableRemoteQueue(dest, remote_dir, s_obj=server)
-                except paramiko.ssh_exception.NoValidConnectionsError as e:
-                    if e.errno is None:
-                        if "tunnel" in server:
-                            if check_permission_denied(s):
-                                msg("Incorrect password for {0}.", server["tunnel"])
-                                sys.exit(1)
-                            if not check_tunnel(s):
-                                msg("Error starting tunnel! Re-run with -vv for more information.")
-                                sys.exit(1)
-                            time.sleep(1)
-                    else:
-                        raise e
+            if server.needs_tunnel_process() and not wait_tunnel(s):
+                if check_permission_denied(s):
+                    msg("Incorrect password for {0}.", server["tunnel"])
+                    sys.exit(1)
+                msg("Error starting tunnel! Re-run with -vv for more information.")
+                sys.exit(1)
+            ALL_REMOTES[s] = TunnelableRemoteQueue(dest, remote_dir, s_obj=server)
         return ALL_REMOTES[s]
 
-def test_connection(server, save):
-    s = server.name
+def prompt_passwords(server):
     if server.get("needs_pw", False):
         server["password"] = ask_password(server["username"], server["hostname"])
+    if "tunnel" in server and server.get("needs_tunnel_pw", False):
+        tunnel = parse_ssh_destination(server["tunnel"])
+        ask_password(tunnel["username"], tunnel["hostname"]) # remembered for _setup_tunnel
+
+def test_connection(server, save):
+    s = server.name
+    prompt_passwords(server)
     msg("Checking connectivity of {0}", s)
     conn = get_remote(server)
     conn.check_call("hostname")
@@ -585,10 +1235,74 @@ def test_connection(server, save):
         server.set_change(True)
         server.close()
 
-def init_passwords():
-    with MAIN_LOCK:
-        for s in get_servers():
-            test_connection(get_server(s), False)
+SERVER_READY = {}
+def get_readiness(s):
+    """Returns the startup state of a server: None if the server has not
+       been checked, "connecting", "ready", or the error message of the
+       failed connectivity check.
+    """
+    return SERVER_READY.get(s)
+
+def _check_ready(server):
+    SERVER_READY[server.name] = "connecting"
+    start = time.time()
+    try:
+        get_remote(server).check_call("hostname")
+    except SystemExit:
+        # tunnels exit on fatal errors which would only end the worker thread
+        raise ValueError("connection aborted")
+    return time.time() - start
+
+def _needs_prompt(server):
+    """Whether connecting to the server asks the user to accept its host key."""
+    return server.get("key", {}).get("base64", None) is None
+
+def init_passwords(wait=True):
+    """Asks for all passwords first and then checks the connectivity of all
+       servers. Servers whose host key is not known yet are checked one by
+       one in the calling thread since the user has to confirm the key. All
+       other servers are checked in parallel. If wait is False those checks
+       continue in the background and a summary is printed once they are
+       done.
+    """
+    servers = [ get_server(s) for s in get_servers() ]
+    for server in servers:
+        prompt_passwords(server)
+        SERVER_READY[server.name] = "connecting"
+    if not servers:
+        return
+
+    def report(server, elapsed, err):
+        if err is None:
+            SERVER_READY[server.name] = "ready"
+            msg("  {0}: ready ({1:.1f}s)", server.name, elapsed)
+        else:
+            SERVER_READY[server.name] = "{0}".format(err)
+            msg("  {0}: unavailable -- {1}", server.name, err)
+
+    interactive = [ server for server in servers if _needs_prompt(server) ]
+    servers = [ server for server in servers if not _needs_prompt(server) ]
+    for server in interactive:
+        msg("Checking connectivity of {0}", server.name)
+        try:
+            elapsed, err = _check_ready(server), None
+        except Exception as e:
+            elapsed, err = None, e
+        report(server, elapsed, err)
+    if not servers:
+        return
+
+    def check():
+        msg("Checking connectivity of {0} servers", len(servers))
+        for (server, elapsed, err) in run_parallel(_check_ready, servers):
+            report(server, elapsed, err)
+
+    if wait:
+        check()
+    else:
+        t = threading.Thread(target=check, name="Connectivity-Check")
+        t.daemon = True
+        t.start()
 
 def _check_project(name):
     p = get_project(name)
@@ -597,24 +1311,137 @@ def _check_project(name):
     p.set_change(True)
     p.close()
 
+class RemoteTimeout(Exception):
+    pass
+
+PARALLEL_WORKERS = 8
+def run_parallel(func, items, timeout=None, max_workers=PARALLEL_WORKERS):
+    """Calls func for every item using a bounded number of worker threads.
+       Returns a list of (item, result, error) tuples in the order of items.
+       error is None if the call succeeded or the raised exception otherwise.
+       Calls that take longer than timeout seconds are reported with a
+       RemoteTimeout and left running in the background. Their workers get
+       replaced so that the remaining items are not blocked.
+    """
+    items = list(items)
+    if not items:
+        return []
+    cond = threading.Condition()
+    states = [ {} for _ in items ]
+    todo = list(range(len(items)))
+    todo.reverse()
+
+    def work():
+        while True:
+            with cond:
+                if not todo:
+                    return
+                ix = todo.pop()
+                states[ix]["start"] = time.time()
+            try:
+                res, err = func(items[ix]), None
+            except Exception as e:
+                res, err = None, e
+            except BaseException as e:
+                # tunnels and prompts exit on fatal errors which would only
+                # end this worker and leave the item unfinished forever
+                res, err = None, ValueError("call aborted: {0}".format(type(e).__name__))
+            with cond:
+                if "done" not in states[ix]:
+                    states[ix]["done"] = (res, err)
+                    cond.notify_all()
+                if states[ix].get("abandoned", False):
+                    return
+
+    def spawn():
+        t = threading.Thread(target=work, name="Parallel-Worker")
+        t.daemon = True
+        t.start()
+
+    for _ in range(min(max_workers, len(items))):
+        spawn()
+    with cond:
+        while not all("done" in st for st in states):
+            wait = None
+            if timeout is not None:
+                now = time.time()
+                for st in states:
+                    if "done" in st or "start" not in st:
+                        continue
+                    left = st["start"] + timeout - now
+                    if left <= 0:
+                        st["done"] = (None, RemoteTimeout("timeout after {0}s".format(timeout)))
+                        st["abandoned"] = True
+                        spawn()
+                    elif wait is None or left < wait:
+                        wait = left
+                if all("done" in st for st in states):
+                    break
+            cond.wait(wait)
+        return [ (items[ix], st["done"][0], st["done"][1]) for (ix, st) in enumerate(states) ]
+
 def list_jobs(rq):
     try:
         return [ ji for ji in rq.list() ]
     except QueueDoesntExist:
         return []
 
+def _remove_temp(paths):
+    for path in paths:
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+def kill_jobs(rq, s, jobs):
+    """Kills and deletes jobs on a server with one remote call. Local copies
+       of their files are removed in the background. Returns (job, code)
+       tuples of jobs that could not be deleted.
+    """
+    failed = rq.kill_jobs(jobs)
+    keep = set(j for (j, _) in failed)
+    paths = [ str(PosixPath(DIR_TEMP) / s / j) for j in jobs if j not in keep ]
+    t = threading.Thread(target=_remove_temp, args=(paths,), name="Cleanup-{0}".format(s))
+    t.daemon = True
+    t.start()
+    for (j, code) in failed:
+        msg("could not delete job {0} on {1}: {2}", j, s, code)
+    return failed
+
 def kill_job(rq, s, j):
+    return not kill_jobs(rq, s, [ j ])
+
+_ARCHIVE_GLOB = re.compile(r"^[\w.*?\[\]/-]+$")
+def open_archive(rq, j, pattern=None):
+    """Packs the job directory or the files matching the glob pattern inside
+       of it into a tar stream that gets compressed on the server. Returns a
+       CommandOutput or None if the job does not exist.
+    """
+    pattern = pattern or "."
+    if not _ARCHIVE_GLOB.match(pattern) or pattern.startswith("/") or ".." in pattern.split("/"):
+        raise ValueError("invalid pattern '{0}'".format(pattern))
     try:
-        rq.kill(j)
-    except (RemoteCommandFailure, JobNotFound):
-        pass
-    try:
-        rq.delete(j)
+        status, path, result = rq.status(j)
     except JobNotFound:
-        pass
-    path = str(PosixPath(DIR_TEMP) / s / j)
-    if os.path.exists(path):
-        shutil.rmtree(path)
+        return None
+    return rq.open_output("cd {0} && tar -czf - -- {1}".format(shell_escape(str(path)), pattern))
+
+def extract_archive(f, dest):
+    """Unpacks a compressed tar stream into dest while reading it. Members
+       that would end up outside of dest are skipped. Returns the number of
+       extracted members.
+    """
+    num = 0
+    tar = tarfile.open(fileobj=f, mode="r|gz")
+    try:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if os.path.isabs(name) or name.split(os.sep)[0] == ".." or member.issym() or member.islnk():
+                msg("skipping {0}", member.name)
+                continue
+            tar.extract(member, dest)
+            num += 1
+    finally:
+        tar.close()
+    return num
 
 def remove_server(s):
     with MAIN_LOCK:
@@ -625,8 +1452,7 @@ def remove_server(s):
         server = get_server(s)
         test_connection(server, False)
         rq = get_remote(server)
-        for (j, _) in list_jobs(rq):
-            kill_job(rq, s, j)
+        kill_jobs(rq, s, [ j for (j, _) in list_jobs(rq) ])
         rpath = str(rq.queue)
         msg("removing server side files '{0}'", rpath)
         rq.check_call("rm -rf -- {0}".format(rpath))
@@ -825,8 +1651,9 @@ def add_server():
         if _ask_yesno("Is a tunnel needed?"):
             tunnel_host = _ask("Tunnel hostname")
             tunnel_user = _ask("Tunnel username")
+            builtin = _ask_yesno("Use the built-in tunnel instead of an ssh process?")
             tport_final = None
-            while tport_final is None:
+            while tport_final is None and not builtin:
                 tport = 11111
                 blocked = set(_get_tunnel_ports())
                 while tport in blocked:
@@ -837,7 +1664,10 @@ def add_server():
                 if tport_final in blocked:
                     msg("Port {0} is not unique!", tport_final)
                     tport_final = None
-            server["tunnel_port"] = tport_final
+            if builtin:
+                server["tunnel_engine"] = TUNNEL_ENGINE_PARAMIKO
+            else:
+                server["tunnel_port"] = tport_final
             tunnel_port = _ask_port("Standard tunnel port", default=22)
             server["tunnel"] = "{0}@{1}{2}".format(
                 tunnel_user,
@@ -5,13 +5,16 @@ from __future__ import division
 
 import os
 import sys
+import json
 import atexit
+import shutil
 import logging
 import argparse
 
 from . import __version__
 import server
 import loading
+import connector
 
 CLAIM_FILE = ".LOCK"
 def claim():
@@ -27,7 +30,7 @@ def claim():
 
 def _start(args):
     server.enable_restart()
-    server.start_server(args.a, args.p, args.quota, args.ram_quota, args.reuse_pw)
+    server.start_server(args.a, args.p, args.quota, args.ram_quota, args.reuse_pw, args.vitals_ttl, args.versions_ttl, args.local_copies)
 
 def _list(args):
     for s in loading.get_servers():
@@ -52,6 +55,56 @@ def _delete(args):
             sys.exit(3)
         loading.remove_server(name)
 
+def _download(args):
+    loading.set_password_reuse(args.reuse_pw)
+    loading.set_msg(loading.simple_msg)
+    s = loading.get_server(args.server)
+    loading.test_connection(s, False)
+    f = loading.open_archive(loading.get_remote(s), args.job, args.glob)
+    if f is None:
+        print("Job {0} not found on {1}".format(args.job, args.server), file=sys.stderr)
+        sys.exit(2)
+    try:
+        if args.archive:
+            with open(args.archive, 'wb') as out:
+                shutil.copyfileobj(f, out)
+            print("Saved {0}".format(args.archive), file=sys.stdout)
+        else:
+            dest = args.output if args.output is not None else args.job
+            num = loading.extract_archive(f, dest)
+            print("Extracted {0} files to {1}".format(num, dest), file=sys.stdout)
+        if f.exit_status() != 0:
+            print("Warning: the archive might be incomplete", file=sys.stderr)
+    finally:
+        f.close()
+
+def _parse_grid(grid):
+    res = {}
+    for g in grid:
+        if "=" not in g:
+            raise ValueError("expected NAME=VALUE,VALUE,... got '{0}'".format(g))
+        name, values = g.split("=", 1)
+        res[name.strip()] = values.split(",")
+    return res
+
+def _batch(args):
+    connector.set_msg(loading.simple_msg)
+    connector.set_password_reuse(args.reuse_pw)
+    grid = _parse_grid(args.grid)
+    points = None
+    if args.points is not None:
+        with open(args.points, 'rb') as f:
+            points = json.load(f)
+    connector.init_passwords()
+    conn = connector.get_connector(args.project)
+    jobs, errors = conn.submit_batch(args.cmd, grid, points, args.server)
+    for (s, j) in jobs:
+        print("{0}@{1}".format(j, s), file=sys.stdout)
+    for (s, err) in errors:
+        print("Submitting to {0} failed: {1}".format(s, err), file=sys.stderr)
+    if errors:
+        sys.exit(2)
+
 def main():
     # root parser
     parser = argparse.ArgumentParser(description='parcell')
@@ -75,11 +128,34 @@ def main():
     parser_delete.add_argument('name', default=None, nargs='?', help="the name of the server to delete if empty everything gets deleted")
     parser_delete.set_defaults(func=_delete)
 
+    # download action
+    parser_download = subparsers.add_parser('download', help="downloads the files of a job")
+    parser_download.add_argument('--reuse-pw', action='store_true', dest='reuse_pw', help="only ask for one password")
+    parser_download.add_argument('--glob', default=None, help="only download files matching the pattern inside the job directory")
+    parser_download.add_argument('-o', '--output', default=None, help="the directory to extract the files to (defaults to the job name)")
+    parser_download.add_argument('--archive', default=None, help="save the compressed archive to the given file instead of extracting it")
+    parser_download.add_argument('server', help="the server of the job")
+    parser_download.add_argument('job', help="the job to download")
+    parser_download.set_defaults(func=_download, claim=False)
+
+    # batch action
+    parser_batch = subparsers.add_parser('batch', help="submits a parameter sweep")
+    parser_batch.add_argument('--reuse-pw', action='store_true', dest='reuse_pw', help="only ask for one password")
+    parser_batch.add_argument('--grid', action='append', default=[], help="NAME=VALUE,VALUE,... adds a parameter to the grid (can be repeated)")
+    parser_batch.add_argument('--points', default=None, help="JSON file containing a list of parameter objects")
+    parser_batch.add_argument('--server', action='append', default=None, help="only use the given server (can be repeated)")
+    parser_batch.add_argument('project', help="the project")
+    parser_batch.add_argument('cmd', help="the command template, e.g., 'python train.py --lr {lr}'")
+    parser_batch.set_defaults(func=_batch)
+
     # start action
     parser_start = subparsers.add_parser('start', help="starts the parcell web interface")
     parser_start.add_argument('--reuse-pw', action='store_true', dest='reuse_pw', help="only ask for one password")
     parser_start.add_argument('--quota', default=4096, help="set cache quota")
     parser_start.add_argument('--ram-quota', default=1024, help="set RAM cache quota")
+    parser_start.add_argument('--vitals-ttl', type=float, default=5, dest='vitals_ttl', help="seconds until server vitals are refreshed")
+    parser_start.add_argument('--versions-ttl', type=float, default=3600, dest='versions_ttl', help="seconds until server versions are refreshed")
+    parser_start.add_argument('--local-copies', action='store_true', dest='local_copies', help="download job files before serving them instead of streaming")
     parser_start.add_argument('-a', type=str, default="localhost", help="specifies the server address")
     parser_start.add_argument('-p', type=int, default=8000, help="specifies the server port")
     parser_start.set_defaults(func=_start)
@@ -91,7 +167,8 @@ def main():
     level = levels[min(args.verbosity, 3)]
     logging.basicConfig(level=level)
 
-    claim()
+    if getattr(args, "claim", True): # downloads can run next to the web interface
+        claim()
 
     try:
         args.func(args)
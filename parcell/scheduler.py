@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import logging
+import threading
+import traceback
+
+import loading
+
+SCHEDULE_INTERVAL = 5
+DEFAULT_SLOTS = 1
+ACTIVE_STATES = frozenset([ "running", "created", "incomplete" ])
+
+_LOGGER = None
+def logger():
+    global _LOGGER
+    if _LOGGER is None:
+        _LOGGER = logging.getLogger('scheduler')
+    return _LOGGER
+
+def msg(message, *args, **kwargs):
+    print(message.format(*args, **kwargs), file=sys.stdout)
+
+def set_msg(m):
+    global msg
+    msg = m
+
+def get_slots(server):
+    return int(server.get("slots", DEFAULT_SLOTS))
+
+def within_thresholds(server, vitals):
+    """Whether the vitals of a server allow starting another job. Thresholds
+       are upper limits for ascending vitals (lower is better) and lower
+       limits otherwise. Unknown vital values never pass a threshold.
+    """
+    thresholds = server.get("thresholds", {})
+    for (name, num, asc) in vitals:
+        if name not in thresholds:
+            continue
+        if math.isnan(num):
+            return False
+        limit = float(thresholds[name])
+        if (asc and num > limit) or (not asc and num < limit):
+            return False
+    return True
+
+class Scheduler(object):
+    """A local queue of jobs of a project. Jobs are dispatched to a server
+       once it has a free slot and its vitals are within its thresholds.
+       Servers are tried in the order of their scores. The queue is stored
+       next to the project config and survives restarts.
+    """
+    def __init__(self, conn, name):
+        self._conn = conn
+        self._path = loading.get_queue_path(name)
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._pending = self._load()
+        t = threading.Thread(target=self._loop, name="Scheduler-{0}".format(name))
+        t.daemon = True
+        t.start()
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return []
+        with open(self._path, 'rb') as f:
+            return json.load(f)
+
+    def _save(self):
+        if not self._pending:
+            if os.path.exists(self._path):
+                os.remove(self._path)
+            return
+        tmp = "{0}.tmp".format(self._path)
+        with open(tmp, 'wb') as f:
+            json.dump(self._pending, f, indent=2, sort_keys=True)
+        os.rename(tmp, self._path)
+
+    def enqueue(self, cmds, servers=None):
+        """Adds commands to the end of the queue. If servers is given only
+           those servers are considered for the commands. Returns the ids of
+           the queued entries.
+        """
+        for cmd in cmds:
+            if not cmd.strip():
+                raise ValueError("cannot execute empty command: {0}".format(cmd))
+        now = time.time()
+        entries = [ {
+            "id": uuid.uuid4().hex,
+            "cmd": cmd,
+            "servers": list(servers) if servers else None,
+            "time": now,
+        } for cmd in cmds ]
+        with self._lock:
+            self._pending.extend(entries)
+            self._save()
+        self.wake()
+        return [ e["id"] for e in entries ]
+
+    def cancel(self, entry_id):
+        with self._lock:
+            num = len(self._pending)
+            self._pending = [ e for e in self._pending if e["id"] != entry_id ]
+            if len(self._pending) == num:
+                return False
+            self._save()
+            return True
+
+    def get_pending(self):
+        with self._lock:
+            return [ dict(e) for e in self._pending ]
+
+    def wake(self):
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(SCHEDULE_INTERVAL)
+            self._wake.clear()
+            with self._lock:
+                if not self._pending:
+                    continue
+            try:
+                self.dispatch()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                msg("Error while scheduling jobs:\n{0}", traceback.format_exc())
+
+    def _get_free(self):
+        conn = self._conn
+        servers = conn.get_servers()
+        active = dict((s, 0) for s in servers)
+        for (s, _, status) in conn.get_all_jobs():
+            if s in active and status in ACTIVE_STATES:
+                active[s] += 1
+        # ranking and thresholds use the same snapshot of the vitals
+        snapshot = conn.get_all_vitals()
+        all_vitals = dict(snapshot)
+        # only servers with vitals within the thresholds of the environment
+        ranking = [ s for (s, _) in conn.score_servers(snapshot) ]
+        free = {}
+        for s in ranking:
+            server = loading.get_server(s)
+            if not within_thresholds(server, all_vitals[s]):
+                continue
+            slots = get_slots(server) - active[s]
+            if slots > 0:
+                free[s] = slots
+        return free, ranking
+
+    def dispatch(self):
+        """Starts as many queued jobs as the servers allow."""
+        free, ranking = self._get_free()
+        if not free:
+            return
+        with self._lock:
+            pending = list(self._pending)
+        for entry in pending:
+            cands = [ s for s in ranking if free.get(s, 0) > 0 and (entry["servers"] is None or s in entry["servers"]) ]
+            if not cands:
+                continue
+            s = cands[0]
+            try:
+                job = self._conn.submit_job(s, entry["cmd"])
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                logger().warning("could not start queued job on %s:\n%s", s, traceback.format_exc())
+                free[s] = 0
+                continue
+            free[s] -= 1
+            logger().info("dispatched %s to %s as %s", entry["cmd"], s, job)
+            with self._lock:
+                self._pending = [ e for e in self._pending if e["id"] != entry["id"] ]
+                self._save()
+            if not any(v > 0 for v in free.values()):
+                break
@@ -4,23 +4,72 @@ from __future__ import print_function
 from __future__ import division
 
 import os
+import re
 import sys
 import time
 import threading
+import mimetypes
 import webbrowser
 
 from connector import get_envs, get_servers, get_projects, \
                       get_connector, init_passwords, set_password_reuse, \
-                      set_msg
+                      set_msg, set_stats_ttl, set_local_copies, \
+                      set_file_quota, resume_schedulers
 from loading import allow_ask
 
 from quick_server import create_server, msg, setup_restart, \
-                         has_been_restarted, is_original
+                         has_been_restarted, is_original, json_dumps
 from quick_cache import QuickCache
 
 set_msg(msg)
 
 PARCEL_MNT = '/parcell/'
+
+EVENTS_KEEPALIVE = 15
+EVENTS_DURATION = 10 * 60
+class JobEventStream(object):
+    """A file like object producing server-sent events for job changes of a
+       project. Reads block until the next change and the stream ends after
+       EVENTS_DURATION seconds. Browsers reconnect automatically and continue
+       from the last received version via the Last-Event-ID header.
+    """
+
+    def __init__(self, conn, version):
+        self._conn = conn
+        self._version = version
+        self._end = time.time() + EVENTS_DURATION
+        self._size = 0
+        self._closed = False
+        conn.add_job_listener()
+
+    def read(self, size=-1):
+        if self._closed or time.time() >= self._end:
+            return ""
+        version, full, jobs, removed = self._conn.wait_jobs(self._version, EVENTS_KEEPALIVE)
+        if version == self._version or (not full and not jobs and not removed):
+            res = ": keepalive\n\n"
+        else:
+            self._version = version
+            names = self._conn.get_job_names()
+            data = json_dumps({
+                "version": version,
+                "full": full,
+                "jobs": jobs,
+                "names": dict((j, names[j]) for (_, j, _) in jobs if j in names),
+                "removed": removed,
+            })
+            res = "id: {0}\n{1}\n\n".format(version, "\n".join("data: {0}".format(l) for l in data.split("\n")))
+        self._size += len(res)
+        return res
+
+    def tell(self):
+        return self._size
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._conn.remove_job_listener()
+
 def get_server(addr, port, cache):
     server = create_server((addr, port))
 
@@ -110,6 +159,50 @@ def get_server(addr, port, cache):
             "cmds": conn.get_commands(),
         }
 
+    @server.json_worker(prefix + '/start_batch')
+    def json_start_batch(args):
+        project = args["project"]
+        template = args["cmd"]
+        conn = get_connector(project)
+        jobs, errors = conn.submit_batch(template, args.get("grid", None), args.get("points", None), args.get("servers", None))
+        return {
+            "project": project,
+            "jobs": jobs,
+            "errors": [ (s, "{0}".format(err)) for (s, err) in errors ],
+            "cmds": conn.get_commands(),
+        }
+
+    @server.json_worker(prefix + '/schedule')
+    def json_schedule(args):
+        project = args["project"]
+        conn = get_connector(project)
+        ids = conn.schedule_jobs(args["cmd"], args.get("grid", None), args.get("points", None), args.get("servers", None))
+        return {
+            "project": project,
+            "queued": ids,
+            "queue": conn.get_queue(),
+            "cmds": conn.get_commands(),
+        }
+
+    @server.json_worker(prefix + '/queue')
+    def json_queue(args):
+        project = args["project"]
+        conn = get_connector(project)
+        return {
+            "project": project,
+            "queue": conn.get_queue(),
+        }
+
+    @server.json_worker(prefix + '/unschedule')
+    def json_unschedule(args):
+        project = args["project"]
+        conn = get_connector(project)
+        conn.cancel_queued(args["id"])
+        return {
+            "project": project,
+            "queue": conn.get_queue(),
+        }
+
     @server.json_worker(prefix + '/jobs')
     def json_jobs(args):
         project = args["project"]
@@ -117,8 +210,27 @@ def get_server(addr, port, cache):
         return {
             "project": project,
             "jobs": conn.get_all_jobs(),
+            "names": conn.get_job_names(),
         }
 
+    def job_events(req, args):
+        args = args["query"]
+        project = args["project"]
+        try:
+            version = int(req.headers.getheader('last-event-id') or args.get("version", 0))
+        except ValueError:
+            version = 0
+        conn = get_connector(project)
+        req.send_response(200)
+        req.send_header("Content-Type", "text/event-stream")
+        req.send_header("Cache-Control", "no-cache")
+        req.send_header("Connection", "close")
+        req.end_headers()
+        return JobEventStream(conn, version)
+
+    server._add_file_mask(prefix + '/job_events', 'GET', job_events)
+    server.set_file_argc(prefix + '/job_events', None)
+
     @server.json_worker(prefix + '/kill_job')
     def json_kill(args):
         project = args["project"]
@@ -152,38 +264,99 @@ def get_server(addr, port, cache):
             "project": project,
             "server": server,
             "job": job,
+            "name": conn.get_job_names().get(job),
             "status": status,
             "result": result,
         }
 
     @server.json_worker(prefix + '/ls')
-    def json_status(args):
+    def json_ls(args):
         project = args["project"]
         server = args["server"]
         job = args["job"]
         path = args["path"]
+        offset = int(args.get("offset", 0))
+        limit = args.get("limit", None)
         conn = get_connector(project)
+        files, total = conn.get_job_files(server, job, path, offset,
+                                          int(limit) if limit is not None else None,
+                                          args.get("sort", "mtime"),
+                                          args.get("desc", True))
         return {
             "project": project,
             "server": server,
             "job": job,
             "path": path,
-            "files": conn.get_job_files(server, job, path),
+            "files": files,
+            "offset": offset,
+            "total": total,
         }
 
-    @server.text_get(prefix + '/file')
-    def text_get(req, args):
+    def file_get(req, args):
         args = args["query"]
         project = args["project"]
         server = args["server"]
         job = args["job"]
         req_file = args["file"]
         conn = get_connector(project)
-        filename = conn.get_job_file(server, job, req_file)
-        if filename is None:
+        ctype = mimetypes.guess_type(req_file)[0] or "text/plain"
+        try:
+            rng = get_file_range(req, args)
+        except ValueError:
+            req.send_error(400, "Invalid range")
+            return None
+        offset, length, tail, is_http = rng if rng is not None else (None, None, None, False)
+        res = conn.open_job_file(server, job, req_file, offset, length, tail)
+        if res is None:
+            req.send_error(404, "File not found")
             return None
-        with open(filename, 'rb') as f:
-            return f.read()
+        f, start, length, size = res
+        # query ranges are used for following files and may be empty
+        code = 206 if is_http else 200
+        if code == 206 and not length and size:
+            f.close()
+            req.send_response(416)
+            req.send_header("Content-Range", "bytes */{0}".format(size))
+            req.end_headers()
+            return None
+        req.send_response(code)
+        req.send_header("Content-Type", ctype)
+        req.send_header("Content-Length", length)
+        req.send_header("Accept-Ranges", "bytes")
+        req.send_header("Cache-Control", "no-cache")
+        req.send_header("X-File-Offset", start)
+        req.send_header("X-File-Size", size)
+        if code == 206:
+            req.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, start + length - 1, size))
+        req.end_headers()
+        return f
+
+    server._add_file_mask(prefix + '/file', 'GET', file_get)
+    server.set_file_argc(prefix + '/file', None)
+
+    def archive_get(req, args):
+        args = args["query"]
+        project = args["project"]
+        server = args["server"]
+        job = args["job"]
+        conn = get_connector(project)
+        try:
+            f = conn.open_job_archive(server, job, args.get("glob", None))
+        except ValueError as e:
+            req.send_error(400, "{0}".format(e))
+            return None
+        if f is None:
+            req.send_error(404, "Job not found")
+            return None
+        req.send_response(200)
+        req.send_header("Content-Type", "application/gzip")
+        req.send_header("Content-Disposition", "attachment; filename=\"{0}.tar.gz\"".format(job))
+        req.send_header("Connection", "close")
+        req.end_headers()
+        return f
+
+    server._add_file_mask(prefix + '/archive', 'GET', archive_get)
+    server.set_file_argc(prefix + '/archive', None)
 
     def complete_cache_clear(args, text):
         if args:
@@ -200,23 +373,50 @@ def get_server(addr, port, cache):
 
     return server
 
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+def get_file_range(req, args):
+    """Interprets the byte range of a file request as (offset, length, tail,
+       is_http). Query arguments "offset" / "length" and "tail" take
+       precedence over a HTTP Range header. Returns None if the whole file
+       is requested.
+    """
+    def num(name):
+        return int(args[name]) if args.get(name, "") != "" else None
+
+    offset, length, tail = num("offset"), num("length"), num("tail")
+    if offset is not None or length is not None or tail is not None:
+        return offset, length, tail, False
+    header = req.headers.getheader('range')
+    m = _RANGE.match(header.strip()) if header else None
+    if m is None or m.group(1) == m.group(2) == "":
+        return None
+    if m.group(1) == "":
+        return None, None, int(m.group(2)), True
+    start = int(m.group(1))
+    return start, int(m.group(2)) - start + 1 if m.group(2) else None, None, True
+
 def is_child():
     return not is_original()
 
 def enable_restart():
     setup_restart()
 
-def start_server(addr, port, cache_quota, ram_quota, reuse_pw):
+def start_server(addr, port, cache_quota, ram_quota, reuse_pw, vitals_ttl, versions_ttl, local_copies):
     cache_temp = "tmp"
     if os.path.exists("cache_path.txt"):
         with open("cache_path.txt") as cp:
             cache_temp = cp.read().strip()
 
+    set_stats_ttl(vitals_ttl, versions_ttl)
+    set_local_copies(local_copies)
+    set_file_quota(cache_quota)
+
     msg("{0}", " ".join(sys.argv))
     msg("initializing passwords -- please type as prompted")
     set_password_reuse(reuse_pw)
-    init_passwords()
+    init_passwords(wait=False) # slow servers keep connecting in the background
     msg("initializing passwords -- done")
+    resume_schedulers()
 
     server = get_server(addr, port, QuickCache(quota=cache_quota, ram_quota=ram_quota, temp=cache_temp, warnings=msg))
     urlstr = "http://{0}:{1}{2}".format(addr if addr else 'localhost', port, PARCEL_MNT)
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import division
+
+import os
+import zlib
+import uuid
+import hashlib
+import logging
+import tarfile
+import threading
+from tej import JobAlreadyExists, JobNotFound, RemoteCommandFailure
+from tej.submission import check_jobid
+from tej.utils import shell_escape
+
+import loading
+from index import DIR_MARKER, read_ignore
+
+UPLOAD_TREE = "tree"
+UPLOAD_BLOBS = "blobs"
+UPLOAD_TAR = "tar"
+UPLOAD_SNAPSHOT = "snapshot"
+UPLOAD_AUTO = "auto"
+UPLOAD_MODES = [ UPLOAD_TREE, UPLOAD_BLOBS, UPLOAD_TAR, UPLOAD_SNAPSHOT, UPLOAD_AUTO ]
+UPLOAD_DEFAULT = UPLOAD_TREE
+# modes resulting in the same (writable) job directory as long as the
+# project has no ignore patterns (only the tar mode applies them)
+AUTO_MODES = [ UPLOAD_TREE, UPLOAD_TAR ]
+AUTO_DECAY = 0.5
+# every AUTO_RESAMPLE-th choice measures one of the slower modes again
+AUTO_RESAMPLE = 10
+
+# remote commands to decompress tar streams
+COMPRESSIONS = {
+    "gzip": "gzip -dc",
+    "zstd": "zstd -dc",
+    "none": "cat",
+}
+COMPRESSION_DEFAULT = "gzip"
+COMPRESSION_LEVEL_DEFAULT = 6
+
+DIR_BLOBS = "blobs"
+DIR_SNAPSHOTS = "snapshots"
+DIR_VERSIONS = loading.DIR_REMOTE_VERSIONS
+EXT_REFS = loading.EXT_REMOTE_REFS
+MAX_UPLOAD_ROUNDS = 3
+
+# exit codes of the remote blob script
+EXIT_JOB_EXISTS = 4
+EXIT_MISSING_BLOBS = 5
+EXIT_MISSING_VERSION = 6
+
+class PartialSubmission(Exception):
+    """Raised if a batch failed after some of its jobs had been submitted.
+       created contains the ids of those jobs.
+    """
+    def __init__(self, created, error):
+        super(PartialSubmission, self).__init__("{0} (submitted before: {1})".format(error, ", ".join(created)))
+        self.created = created
+        self.error = error
+
+def _batch_lines(output, prefix):
+    return [ l.strip()[len(prefix):] for l in output.split("\n") if l.strip().startswith(prefix) ]
+
+def _batch_result(ret, output, command):
+    """Interprets the output of a batch script. Returns the ids of jobs that
+       already exist if the batch succeeded and raises otherwise.
+    """
+    if ret == 0:
+        return _batch_lines(output, "exists ")
+    err = RemoteCommandFailure(command=command, ret=ret)
+    created = _batch_lines(output, "created ")
+    if created:
+        raise PartialSubmission(created, err)
+    raise err
+
+_LOGGER = None
+def logger():
+    global _LOGGER
+    if _LOGGER is None:
+        _LOGGER = logging.getLogger('transfer')
+    return _LOGGER
+
+def get_upload_mode(server):
+    mode = server.get("upload", UPLOAD_DEFAULT)
+    if mode not in UPLOAD_MODES:
+        raise ValueError("unknown upload mode '{0}' for {1}".format(mode, server.name))
+    return mode
+
+def get_compression(server):
+    compression = server.get("compression", COMPRESSION_DEFAULT)
+    if compression not in COMPRESSIONS:
+        raise ValueError("unknown compression '{0}' for {1}".format(compression, server.name))
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression for {0} needs the 'zstandard' package".format(server.name))
+    return compression, int(server.get("compression_level", COMPRESSION_LEVEL_DEFAULT))
+
+_TIMINGS_LOCK = threading.RLock()
+_TIMINGS = {}
+_CHOICES = {}
+def get_auto_modes(path):
+    """Returns the modes auto mode chooses from for the project at path. The
+       job directory must not depend on the choice so projects with ignore
+       patterns always use the tar mode.
+    """
+    if read_ignore(path):
+        return [ UPLOAD_TAR ]
+    return AUTO_MODES
+
+def choose_mode(server, path):
+    """Returns the upload mode for the next submission of the project at
+       path to the server. In auto mode every mode of get_auto_modes is
+       tried once and afterwards the one with the lowest average upload
+       time is used. Every AUTO_RESAMPLE-th choice is one of the other modes
+       (in turn) so that their timings follow changes of the connection or
+       the project.
+    """
+    mode = get_upload_mode(server)
+    if mode != UPLOAD_AUTO:
+        return mode
+    modes = get_auto_modes(path)
+    if len(modes) == 1:
+        return modes[0]
+    with _TIMINGS_LOCK:
+        timings = _TIMINGS.get(server.name, {})
+        for m in modes:
+            if m not in timings:
+                return m
+        best = min(modes, key=lambda m: timings[m])
+        num = _CHOICES.get(server.name, 0) + 1
+        _CHOICES[server.name] = num
+        if num % AUTO_RESAMPLE != 0:
+            return best
+        others = [ m for m in modes if m != best ]
+        return others[(num // AUTO_RESAMPLE - 1) % len(others)]
+
+def needs_manifest(mode):
+    """Whether submissions in the given mode use the manifest of the project."""
+    return mode != UPLOAD_TREE
+
+def record_upload(server, mode, seconds):
+    with _TIMINGS_LOCK:
+        timings = _TIMINGS.setdefault(server.name, {})
+        if mode in timings:
+            seconds = AUTO_DECAY * timings[mode] + (1.0 - AUTO_DECAY) * seconds
+        timings[mode] = seconds
+
+def submit(rq, mode, job_id, path, script_file, cmd, manifest, compression=None):
+    """Submits a job. manifest is the manifest of path as computed by
+       ProjectIndex.refresh and is used in blobs, tar, and snapshot mode.
+       compression is a (name, level) tuple for uploading tar streams.
+    """
+    call = "sh -l ./{0}".format(script_file)
+    if mode == UPLOAD_BLOBS:
+        if _submit_blobs(rq, [ (job_id, cmd) ], script_file, call, manifest):
+            raise JobAlreadyExists
+        logger().info("Submitted job %s", job_id)
+        return job_id
+    if mode == UPLOAD_TAR:
+        if _submit_tar(rq, [ (job_id, cmd) ], path, script_file, call, manifest, compression):
+            raise JobAlreadyExists
+        logger().info("Submitted job %s", job_id)
+        return job_id
+    if mode == UPLOAD_SNAPSHOT:
+        if _submit_snapshot(rq, [ (job_id, cmd) ], path, script_file, call, manifest, compression):
+            raise JobAlreadyExists
+        logger().info("Submitted job %s", job_id)
+        return job_id
+    with open(os.path.join(path, script_file), 'wb') as f:
+        print(cmd, file=f)
+    return rq.submit(job_id, path, call)
+
+def _upload_blobs(rq, queue, blobs, files):
+    sftp = rq.get_sftp()
+    try:
+        for blob in blobs:
+            if blob not in files:
+                raise ValueError("remote requested unknown blob {0}".format(blob))
+            dest = "{0}/{1}/{2}".format(queue, DIR_BLOBS, blob)
+            tmp = "{0}.{1}.tmp".format(dest, os.getpid())
+            logger().debug("upload blob %s for %s", blob, files[blob])
+            sftp.put(files[blob], tmp)
+            # blobs are shared between jobs via hardlinks and must never change
+            sftp.chmod(tmp, 0o555 if blob.endswith("x") else 0o444)
+            sftp.posix_rename(tmp, dest)
+    finally:
+        sftp.close()
+
+def _submit_blobs(rq, jobs, script_file, call, manifest):
+    """Submits jobs with workspaces that are hardlinks into the blob store
+       of the server. Blobs the server does not have yet are uploaded and
+       the submission is repeated. Returns the ids of jobs that already
+       exist.
+    """
+    queue = rq.get_queue()
+    manifest, files = manifest
+    data = "".join("{0} {1}\n".format(blob, rel) for (blob, rel) in manifest)
+    prepare = """
+mkdir -p {blobs}
+manifest="$(mktemp)"
+trap 'rm -f "$manifest"' EXIT
+cat > "$manifest"
+missing=0
+while read -r blob rel; do
+    if [ "$blob" != {marker} ] && ! [ -f "{blobs}/$blob" ]; then
+        echo "missing $blob"
+        missing=1
+    fi
+done < "$manifest"
+if [ $missing -ne 0 ]; then
+    exit {exit_missing}
+fi
+""".format(blobs=DIR_BLOBS, marker=DIR_MARKER, exit_missing=EXIT_MISSING_BLOBS)
+    populate = """
+    mkdir "$target"
+    while read -r blob rel; do
+        if [ "$blob" = {marker} ]; then
+            mkdir -p "$target/$rel"
+        else
+            ln "{blobs}/$blob" "$target/$rel"
+        fi
+    done < "$manifest"
+""".format(blobs=DIR_BLOBS, marker=DIR_MARKER)
+    script = _batch_script(queue, jobs, script_file, call, prepare, populate)
+    for _ in range(MAX_UPLOAD_ROUNDS):
+        ret, output = rq.call_input(script, data)
+        if ret != EXIT_MISSING_BLOBS:
+            return _batch_result(ret, output, "blob submit")
+        missing = sorted(set(_batch_lines(output, "missing ")))
+        logger().debug("uploading %d missing blobs", len(missing))
+        _upload_blobs(rq, queue, missing, files)
+    raise JobNotFound("Couldn't create jobs: blobs keep missing")
+
+class _Compressor(object):
+    """Compresses everything written to it and passes the result on to
+       out. Supports the formats of COMPRESSIONS.
+    """
+    def __init__(self, out, compression, level):
+        self._out = out
+        if compression == "gzip":
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == "zstd":
+            import zstandard
+            self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self._obj = None
+
+    def write(self, buff):
+        if self._obj is not None:
+            buff = self._obj.compress(buff)
+        if buff:
+            self._out(buff)
+
+    def close(self):
+        if self._obj is not None:
+            self._out(self._obj.flush())
+            self._obj = None
+
+def _write_tar(out, path, manifest, compression):
+    """Streams the files of the manifest as compressed tar to out."""
+    name, level = compression or (COMPRESSION_DEFAULT, COMPRESSION_LEVEL_DEFAULT)
+    comp = _Compressor(out, name, level)
+    tar = tarfile.open(fileobj=comp, mode="w|", dereference=True)
+    try:
+        for (_, rel) in manifest[0]:
+            tar.add(os.path.join(path, *rel.split("/")), arcname=rel, recursive=False)
+    finally:
+        tar.close()
+    comp.close()
+
+def _unpack_cmd(compression, dest):
+    name = (compression or (COMPRESSION_DEFAULT, ))[0]
+    return "{0} | tar -xf - -C {1}".format(COMPRESSIONS[name], dest)
+
+def _submit_tar(rq, jobs, path, script_file, call, manifest, compression):
+    """Submits jobs by unpacking one tar stream of the project directly into
+       the directory of every job. Returns the ids of jobs that already
+       exist.
+    """
+    populate = """
+    mkdir "$target"
+    {unpack}
+""".format(unpack=_unpack_cmd(compression, '"$target"'))
+    script = _batch_script(rq.get_queue(), jobs, script_file, call, "", populate)
+    ret, output = rq.call_input(script, lambda out: _write_tar(out, path, manifest, compression))
+    return _batch_result(ret, output, "tar submit")
+
+def _batch_script(queue, jobs, script_file, call, prepare, populate, cleanup=""):
+    """Creates and submits all jobs in one remote call. Prints the ids of
+       submitted jobs and of jobs that already exist (see _batch_result).
+       A job whose directory cannot be populated or submitted is deleted
+       again like tej does and the script stops.
+    """
+    lines = [ """
+set -e
+cd {queue}
+current=""
+trap '[ -z "$current" ] || commands/delete "$current" >/dev/null 2>&1; exit 1' HUP INT TERM
+{prepare}
+submit_one() {{
+    target="$(commands/new_job "$1")" || {{
+        ret=$?
+        if [ $ret -eq {exit_exists} ]; then
+            echo "exists $1"
+            return 0
+        fi
+        exit $ret
+    }}
+    current="$1"
+    set +e
+    (
+        set -e
+{populate}
+        printf '%s\\n' "$2" > "$target/{script_file}"
+        commands/submit "$1" "$target" {call}
+    )
+    ret=$?
+    set -e
+    current=""
+    if [ $ret -ne 0 ]; then
+        commands/delete "$1" >/dev/null 2>&1 || true
+        rm -f {versions}/*{ext_refs}/"$1"
+        exit $ret
+    fi
+    echo "created $1"
+}}
+""".format(
+        queue=shell_escape(queue),
+        versions=DIR_VERSIONS,
+        ext_refs=EXT_REFS,
+        prepare=prepare,
+        exit_exists=EXIT_JOB_EXISTS,
+        populate=populate,
+        script_file=script_file,
+        call=shell_escape(call)) ]
+    for (job_id, cmd) in jobs:
+        check_jobid(job_id)
+        lines.append("submit_one {0} {1}".format(job_id, shell_escape(cmd)))
+    lines.append(cleanup)
+    return "\n".join(lines)
+
+def get_version(manifest):
+    """The version of a project is the hash of its manifest."""
+    h = hashlib.sha1()
+    for (blob, rel) in manifest[0]:
+        h.update("{0} {1}\n".format(blob, rel))
+    return h.hexdigest()
+
+def _upload_version(rq, queue, version, path, manifest, compression):
+    """Uploads a project snapshot. Files of snapshots are read-only since
+       they are shared with the jobs via hardlinks.
+    """
+    final = "{0}/{1}/{2}".format(queue, DIR_VERSIONS, version)
+    tmp = "{0}.{1}.tmp".format(final, uuid.uuid4().hex)
+    script = """
+set -e
+mkdir -p {versions}
+mkdir {tmp}
+{unpack}
+find {tmp} -type f -exec chmod a-w {{}} +
+""".format(
+        versions=shell_escape("{0}/{1}".format(queue, DIR_VERSIONS)),
+        tmp=shell_escape(tmp),
+        unpack=_unpack_cmd(compression, shell_escape(tmp)))
+    ret, _ = rq.call_input(script, lambda out: _write_tar(out, path, manifest, compression))
+    try:
+        if ret != 0:
+            raise RemoteCommandFailure(command="snapshot upload", ret=ret)
+        sftp = rq.get_sftp()
+        try:
+            sftp.posix_rename(tmp, final)
+        except IOError:
+            # another upload of the same version was faster
+            logger().debug("snapshot %s already exists", version)
+        finally:
+            sftp.close()
+    finally:
+        rq.check_call("rm -rf {0}".format(shell_escape(tmp)))
+
+def _submit_snapshot(rq, jobs, path, script_file, call, manifest, compression):
+    """Submits jobs with workspaces that are hardlink copies of a shared
+       snapshot of the project. Snapshots are only uploaded if the server
+       does not have the version yet. Every job leaves a reference in the
+       .refs directory of its snapshot which gets removed when the job is
+       deleted. Returns the ids of jobs that already exist.
+    """
+    queue = rq.get_queue()
+    version = get_version(manifest)
+    prepare = """
+{lock}
+version={versions}/{version}
+refs="$version{ext_refs}"
+lock_versions
+mkdir -p "$refs"
+: > "$refs/.batch.$$"
+unlock_versions
+trap 'rm -f "$refs/.batch.$$"' EXIT
+[ -d "$version" ] || exit {exit_missing}
+""".format(
+        lock=loading.REMOTE_VERSIONS_LOCK,
+        versions=DIR_VERSIONS,
+        version=version,
+        ext_refs=EXT_REFS,
+        exit_missing=EXIT_MISSING_VERSION)
+    populate = """
+    : > "$refs/$1"
+    cp -Rl "$version" "$target"
+"""
+    script = _batch_script(queue, jobs, script_file, call, prepare, populate)
+    for _ in range(MAX_UPLOAD_ROUNDS):
+        ret, output = rq.call_input(script, "")
+        if ret != EXIT_MISSING_VERSION:
+            return _batch_result(ret, output, "snapshot submit")
+        logger().debug("uploading snapshot %s", version)
+        _upload_version(rq, queue, version, path, manifest, compression)
+    raise JobNotFound("Couldn't create jobs: snapshot keeps missing")
+
+def submit_batch(rq, mode, jobs, path, script_file, manifest, compression=None):
+    """Submits multiple jobs sharing one snapshot of path. The project is
+       uploaded only once and copied (tree and tar mode) or hardlinked (blobs
+       and snapshot mode) on the server. jobs is a list of (job_id, cmd) tuples. Returns
+       the ids of jobs that could not be created because they already exist.
+       Raises PartialSubmission if the batch failed after some jobs have
+       been submitted.
+    """
+    call = "sh -l ./{0}".format(script_file)
+    if mode == UPLOAD_SNAPSHOT:
+        return _submit_snapshot(rq, jobs, path, script_file, call, manifest, compression)
+    if mode == UPLOAD_BLOBS:
+        return _submit_blobs(rq, jobs, script_file, call, manifest)
+    queue = rq.get_queue()
+    snapshot = "{0}/{1}/{2}".format(queue, DIR_SNAPSHOTS, uuid.uuid4().hex)
+    populate = """
+    cp -R "$snapshot" "$target"
+    rm -f "$target/{script_file}"
+""".format(script_file=script_file)
+    if mode == UPLOAD_TAR:
+        prepare = """
+snapshot={0}
+trap 'rm -rf "$snapshot"' EXIT
+mkdir -p "$snapshot"
+{1}
+""".format(shell_escape(snapshot), _unpack_cmd(compression, '"$snapshot"'))
+        script = _batch_script(queue, jobs, script_file, call, prepare, populate)
+        ret, output = rq.call_input(script, lambda out: _write_tar(out, path, manifest, compression))
+        return _batch_result(ret, output, "batch submit")
+    rq.check_call("mkdir -p {0}".format(shell_escape(os.path.dirname(snapshot))))
+    try:
+        rq.get_scp_client().put(path, snapshot, recursive=True)
+        prepare = "snapshot={0}".format(shell_escape(snapshot))
+        script = _batch_script(queue, jobs, script_file, call, prepare, populate)
+        ret, output = rq.call_input(script, "")
+    finally:
+        rq.check_call("rm -rf {0}".format(shell_escape(snapshot)))
+    return _batch_result(ret, output, "batch submit")
@@ -6,10 +6,12 @@ from __future__ import division
 import sys
 import time
 import atexit
+import socket
 import getpass
 import logging
 import pexpect
 import argparse
+import paramiko
 import threading
 
 from tej import parse_ssh_destination
@@ -25,33 +27,76 @@ def logger():
 def _pretty_dest(dest):
     return ', '.join("{0}={1}".format(k, v if k != "password" else "***") for k, v in dest.items())
 
+LOCALHOST = "127.0.0.1"
+TUNNEL_TIMEOUT = 30
+PROBE_INTERVAL = 0.1
+
+# tunnel states: 0 starting, 1 spawned, 2 ssh running, 3 port accepts connections
+# -1 terminated, -2 permission denied, -3 unknown host key, -4 missing password
 _LOCK = threading.RLock()
+_LOCKS = {}
 _TUNNELS = {}
 _PROCS = {}
-def start_tunnel(s, via, dest, tunnel_port):
+_STATE_COND = threading.Condition()
+def _get_lock(s):
     with _LOCK:
+        if s not in _LOCKS:
+            _LOCKS[s] = threading.RLock()
+        return _LOCKS[s]
+
+def start_tunnel(s, via, dest, tunnel_port):
+    # only starting the same tunnel twice needs to be prevented
+    with _get_lock(s):
         if check_tunnel(s):
             return
         _forward_tunnel(s, int(tunnel_port), via, dest)
 
 def check_tunnel(s):
-    with _LOCK:
-        if s not in _TUNNELS:
-            return False
-        if _TUNNELS[s] == -3 or _TUNNELS[s] == -4:
-            sys.exit(1)
-        return _TUNNELS[s] > 0
+    state = _TUNNELS.get(s)
+    if state is None:
+        return False
+    if state == -3 or state == -4:
+        sys.exit(1)
+    return state > 0
+
+def _set_state(s, state):
+    with _STATE_COND:
+        _TUNNELS[s] = state
+        _STATE_COND.notify_all()
+
+def _wait_state(s, pred, timeout):
+    end = time.time() + timeout if timeout is not None else None
+    with _STATE_COND:
+        while not pred(_TUNNELS.get(s, 0)):
+            if end is None:
+                _STATE_COND.wait()
+                continue
+            left = end - time.time()
+            if left <= 0:
+                return False
+            _STATE_COND.wait(left)
+        return True
+
+def wait_tunnel(s, timeout=TUNNEL_TIMEOUT):
+    """Waits until the forwarded port of the tunnel accepts connections.
+       Returns False if the tunnel failed or did not become ready within
+       timeout seconds.
+    """
+    if not _wait_state(s, lambda state: state >= 3 or state < 0, timeout):
+        logger().warning("Tunnel for %s not ready after %ss", s, timeout)
+        return False
+    return check_tunnel(s) and _TUNNELS[s] >= 3
 
 def check_permission_denied(s):
-    with _LOCK:
-        if s not in _TUNNELS:
-            return False
-        if _TUNNELS[s] == -3 or _TUNNELS[s] == -4:
-            sys.exit(1)
-        return _TUNNELS[s] == -2
+    state = _TUNNELS.get(s)
+    if state is None:
+        return False
+    if state == -3 or state == -4:
+        sys.exit(1)
+    return state == -2
 
 def clean(s):
-    with _LOCK:
+    with _get_lock(s):
         if _PROCS is not None and _PROCS[s] is not None:
             try:
                 _PROCS[s].terminate()
@@ -63,18 +108,67 @@ def clean(s):
             _PROCS[s] = None
 
 def clean_all():
+    for s in list(_PROCS.keys()):
+        clean(s)
+
+TUNNEL_ENGINE_SSH = "ssh"
+TUNNEL_ENGINE_PARAMIKO = "paramiko"
+TUNNEL_ENGINES = [ TUNNEL_ENGINE_SSH, TUNNEL_ENGINE_PARAMIKO ]
+TUNNEL_ENGINE_DEFAULT = TUNNEL_ENGINE_SSH
+
+_JUMPS = {}
+def _get_jump(via):
+    """Returns the transport to the jump host. All tunnels through the same
+       jump host share one connection which is reopened if it died.
+    """
+    port = int(via.get("port", 22))
+    username = via.get("username", getpass.getuser())
+    key = (username, via["hostname"], port)
+    with _get_lock(key):
+        client = _JUMPS.get(key)
+        if client is not None:
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                return transport
+            client.close()
+        client = paramiko.SSHClient()
+        # like the ssh engine only hosts known to the user are accepted
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        logger().debug("connect to jump host %s", _pretty_dest(via))
+        client.connect(
+            hostname=via["hostname"],
+            port=port,
+            username=username,
+            password=via.get("password", None),
+            look_for_keys=True,
+            allow_agent=True)
+        _JUMPS[key] = client
+        return client.get_transport()
+
+def open_channel(via, dest):
+    """Opens a direct-tcpip channel to dest through the jump host via. The
+       channel can be used as sock argument of a paramiko connection and
+       needs neither an ssh process nor a local port.
+    """
+    transport = _get_jump(via)
+    target = (dest["hostname"], int(dest.get("port", 22)))
+    return transport.open_channel("direct-tcpip", target, (LOCALHOST, 0))
+
+def clean_jumps():
     with _LOCK:
-        for s in _PROCS.keys():
-            clean(s)
+        for key in list(_JUMPS.keys()):
+            _JUMPS.pop(key).close()
 
 atexit.register(clean_all)
+atexit.register(clean_jumps)
 
 def _forward_tunnel(s, local_port, via, remote):
 
     def run():
         log = StringIO()
         try:
-            _TUNNELS[s] = 1
+            _set_state(s, 1)
             cmd = [
                 "ssh",
                 "-N",
@@ -97,7 +191,7 @@ def _forward_tunnel(s, local_port, via, remote):
             proc.logfile_read = log
             _PROCS[s] = proc
             try:
-                _TUNNELS[s] = 2
+                _set_state(s, 2)
                 while True:
                     scenario = proc.expect([ 'RSA key', 'Permission denied', 'password:' ])
                     if scenario == 0:
@@ -105,10 +199,10 @@ def _forward_tunnel(s, local_port, via, remote):
                         print("Please make sure you can connect to the server by running\n")
                         print("ssh -p {0} {1}@{2} hostname\n".format(via.get("port", 22), username, hostname))
                         print("and then try again.")
-                        _TUNNELS[s] = -3
+                        _set_state(s, -3)
                         return
                     elif scenario == 1:
-                        _TUNNELS[s] = -2
+                        _set_state(s, -2)
                         return
                     elif scenario == 2:
                         if stdin is not None:
@@ -118,7 +212,7 @@ def _forward_tunnel(s, local_port, via, remote):
                             print("It seems connecting to {0}@{1} requires a password".format(username, hostname))
                             print("but it is not specified in the server definition '{0}'.".format(s))
                             print("Please adjust the settings and try again.")
-                            _TUNNELS[s] = -4
+                            _set_state(s, -4)
                             return
             except pexpect.EOF:
                 pass
@@ -129,24 +223,41 @@ def _forward_tunnel(s, local_port, via, remote):
             log.seek(0)
             logger().info("SSH tunnel terminated!\nLOG:\n%s", log.read())
             if _TUNNELS[s] >= 0:
-                _TUNNELS[s] = -1
+                _set_state(s, -1)
             clean(s)
 
+    def probe():
+        # ssh only listens on the local port once it is connected
+        while _TUNNELS[s] == 2:
+            try:
+                socket.create_connection((LOCALHOST, local_port), PROBE_INTERVAL * 10).close()
+            except socket.error:
+                _wait_state(s, lambda state: state != 2, PROBE_INTERVAL)
+                continue
+            with _STATE_COND:
+                if _TUNNELS[s] == 2:
+                    _set_state(s, 3)
+            logger().debug('Tunnel accepts connections on port %s', local_port)
+            return
+
     _PROCS[s] = None
-    _TUNNELS[s] = 0
+    _set_state(s, 0)
     t = threading.Thread(target=run, name="Tunnel-{0}".format(s))
     t.daemon = True
     t.start()
     logger().debug('Waiting for tunnel to open...')
-    while _TUNNELS[s] < 2:
-        if _TUNNELS[s] < 0:
-            if _TUNNELS[s] == -3 or _TUNNELS[s] == -4:
-                sys.exit(1)
-            if _TUNNELS[s] == -2:
-                return
-            raise ValueError("Failed to start tunnel!")
-    # DISCLAIMER! Tunnel might not be working yet -- check connection repeatedly
-    logger().debug('Tunnel open! Proceed!')
+    if not _wait_state(s, lambda state: state >= 2 or state < 0, TUNNEL_TIMEOUT):
+        raise ValueError("Timeout while starting tunnel!")
+    if _TUNNELS[s] < 0:
+        if _TUNNELS[s] == -3 or _TUNNELS[s] == -4:
+            sys.exit(1)
+        if _TUNNELS[s] == -2:
+            return
+        raise ValueError("Failed to start tunnel!")
+    p = threading.Thread(target=probe, name="Tunnel-Probe-{0}".format(s))
+    p.daemon = True
+    p.start()
+    logger().debug('Tunnel open! Use wait_tunnel to wait until it accepts connections.')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Parcell Tunnel')
@@ -171,6 +282,7 @@ if __name__ == '__main__':
     dest["password"] =  ask_password(dest["username"], dest["hostname"])
 
     start_tunnel("cmd", tunnel, dest, port)
+    wait_tunnel("cmd")
     try:
         while check_tunnel("cmd"):
             time.sleep(1)
@@ -110,11 +110,14 @@ function Net(statusSel) {
           if(err) {
             console.warn("Failed loading " + ref);
             error();
+            if(s["errCb"]) {
+              s["errCb"](err);
+            }
             return console.warn(err);
           }
           var err = true;
           try {
-            s["cb"](data["response"]);
+            s["cb"](data["response"], data);
             err = false;
           } finally {
             if(err) {
@@ -165,13 +168,14 @@ function Net(statusSel) {
     runStart(ref);
   }; // get
 
-  this.getPlain = function(id, url, args, cb) {
+  this.getPlain = function(id, url, args, cb, errCb) {
     if(!active) return;
     var ref = "GET_PLAIN " + id;
     starts[ref] = {
       "method": "GET_PLAIN",
       "url": that.url(url, args),
       "cb": cb,
+      "errCb": errCb,
     };
     runStart(ref);
   }; // getPlain
@@ -190,6 +194,28 @@ function Net(statusSel) {
     runStart(ref);
   }; // post
 
+  this.listen = function(url, args, cb) {
+    var source = new EventSource(that.url(url, args));
+    source.onmessage = function(e) {
+      var err = true;
+      try {
+        cb(JSON.parse(e.data));
+        err = false;
+      } finally {
+        if(err) {
+          error();
+        }
+      }
+    };
+    source.onerror = function(e) {
+      if(source.readyState === EventSource.CLOSED) {
+        console.warn("Failed listening to " + url);
+        error();
+      }
+    };
+    return source;
+  }; // listen
+
   this.url = function(url, args) {
     return url + that.args(args);
   }; // url